@@ -0,0 +1,112 @@
+"""Throughput of Download.bcat_binary_from_txids against a local stand-in for the whatsonchain API.
+
+The stand-in server serves whatsonchain-style ``/tx/<txid>/hex`` and bulk ``/txs/hex`` responses for
+a fake BCAT file and sleeps ``--latency`` seconds per request to emulate the round trip to a remote API.
+
+    $ python benchmarks/bench_download.py --parts 200 --latency 0.05
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import polyglot
+from polyglot.bitcom import BCATPART
+from polyglot.rawtx import txid_from_rawtx
+
+PART_SIZE = 90_000
+
+
+def make_part_rawtx(data):
+    """A minimal (unsigned) one input, one output tx carrying a BCAT part"""
+    prefix = BCATPART.encode('utf-8')
+    script = (b'\x00\x6a' + bytes([len(prefix)]) + prefix +
+              b'\x4e' + len(data).to_bytes(4, 'little') + data)
+    return (b'\x01\x00\x00\x00' +
+            b'\x01' + os.urandom(32) + b'\x00\x00\x00\x00' + b'\x00' + b'\xff\xff\xff\xff' +
+            b'\x01' + bytes(8) + b'\xfe' + len(script).to_bytes(4, 'little') + script +
+            b'\x00\x00\x00\x00')
+
+
+def make_fake_bcat(num_parts):
+    """returns {txid: rawtx} and the concatenated file"""
+    txs = {}
+    parts = []
+    for _ in range(num_parts):
+        data = os.urandom(PART_SIZE)
+        rawtx = make_part_rawtx(data)
+        txs[txid_from_rawtx(rawtx)] = rawtx
+        parts.append(data)
+    return txs, b''.join(parts)
+
+
+def serve(txs, latency):
+    class Handler(BaseHTTPRequestHandler):
+        requests = 0
+
+        def do_GET(self):
+            txid = self.path.split('/')[-2]
+            self.reply(txs[txid].hex().encode('utf-8'), 'text/plain')
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            result = [{'txid': txid, 'hex': txs[txid].hex()} for txid in payload['txids']]
+            self.reply(json.dumps(result).encode('utf-8'), 'application/json')
+
+        def reply(self, body, content_type):
+            Handler.requests += 1
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.handler = Handler
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SingleRequestDownload(polyglot.Download):
+    """Fetches one txid per request (for comparison with the bulk endpoint)"""
+    def get_rawtxs_bulk(self, txids, verify=True):
+        return [self.get_rawtx(txid, verify=verify) for txid in txids]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--parts', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per request')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    txs, expected = make_fake_bcat(args.parts)
+    txids = list(txs)
+    server = serve(txs, args.latency)
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    print('{} parts, {:.1f} MB, {:.0f} ms latency'.format(args.parts, len(expected) / 1e6, args.latency * 1000))
+    print('{:>6} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('bulk', 'workers', 'seconds', 'parts/s', 'MB/s',
+                                                           'requests'))
+    for downloader_class in (SingleRequestDownload, polyglot.Download):
+        for workers in args.workers:
+            downloader = downloader_class(max_workers=workers, api_url=url)
+            server.handler.requests = 0
+            start = time.perf_counter()
+            data = downloader.bcat_binary_from_txids(txids)
+            elapsed = time.perf_counter() - start
+            assert data == expected
+            print('{:>6} {:>8} {:>10.2f} {:>10.1f} {:>10.2f} {:>10}'.format(
+                str(downloader_class is polyglot.Download), workers, elapsed, args.parts / elapsed,
+                len(data) / 1e6 / elapsed, server.handler.requests))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
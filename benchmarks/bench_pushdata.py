@@ -0,0 +1,76 @@
+"""Microbenchmark of Download.pushdata_views_from_script against the previous copying parser
+on realistic B:// and BCAT part scripts.
+
+    $ python benchmarks/bench_pushdata.py
+"""
+import os
+import timeit
+
+from bitsv import op_return
+
+from polyglot import Download
+from polyglot.bitcom import B, BCATPART
+
+
+def pushdata_from_script_copying(script):
+    """The original parser: hex-decodes the script and copies out every push"""
+    script = bytes.fromhex(script)
+    offset = 0
+    data = []
+    while offset < len(script):
+        opcode = script[offset]
+        offset += 1
+        if opcode == 0x00:
+            data.append(bytes(0))
+        elif opcode <= 0x4b:
+            data.append(script[offset: offset + opcode])
+            offset += opcode
+        elif opcode == 0x4c:
+            length = script[offset]
+            data.append(script[offset + 1: offset + 1 + length])
+            offset += 1 + length
+        elif opcode == 0x4d:
+            length = script[offset] + script[offset + 1] * 0x100
+            data.append(script[offset + 2: offset + 2 + length])
+            offset += 2 + length
+        elif opcode == 0x4e:
+            length = (script[offset] + script[offset + 1] * 0x100 + script[offset + 2] * 0x10000 +
+                      script[offset + 3] * 0x1000000)
+            data.append(script[offset + 4: offset + 4 + length])
+            offset += 4 + length
+        elif opcode == 0x6a:
+            pass
+        else:
+            return []
+    return data
+
+
+def op_return_script(lst_of_pushdata):
+    return b'\x00\x6a' + op_return.create_pushdata(lst_of_pushdata)
+
+
+SCRIPTS = {
+    'B (90 KB jpeg)': op_return_script([(B, 'utf-8'), (os.urandom(90_000), 'bytes'), ('image/jpeg', 'utf-8'),
+                                        ('binary', 'utf-8'), ('photo.jpg', 'utf-8')]),
+    'BCAT part (90 KB)': op_return_script([(BCATPART, 'utf-8'), (os.urandom(90_000), 'bytes')]),
+    'B (200 B text)': op_return_script([(B, 'utf-8'), ('hello world ' * 16, 'utf-8'), ('text/plain', 'utf-8'),
+                                        ('utf-8', 'utf-8'), ('hello.txt', 'utf-8')]),
+}
+
+
+def main():
+    print('{:<20} {:>14} {:>14} {:>14} {:>8}'.format('script', 'copying (us)', 'views hex (us)',
+                                                      'views raw (us)', 'speedup'))
+    for name, script in SCRIPTS.items():
+        script_hex = script.hex()
+        assert pushdata_from_script_copying(script_hex) == Download.pushdata_from_script(script_hex)
+        number = 2000
+        copying = timeit.timeit(lambda: pushdata_from_script_copying(script_hex), number=number) / number
+        views_hex = timeit.timeit(lambda: Download.pushdata_views_from_script(script_hex), number=number) / number
+        views_raw = timeit.timeit(lambda: Download.pushdata_views_from_script(script), number=number) / number
+        print('{:<20} {:>14.2f} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(
+            name, copying * 1e6, views_hex * 1e6, views_raw * 1e6, copying / views_raw))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Scaling of Upload.build_rawtxs (process-pool signing) with the number of processes.
+
+Builds and signs BCAT part txs from pre-assigned fake utxos - nothing touches the network.
+
+    $ python benchmarks/bench_signing.py --txs 2000 --size 1000
+"""
+import argparse
+import os
+import time
+
+from bitsv.network.meta import Unspent
+
+import polyglot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--txs', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=1000, help='bytes of data per part')
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    uploader = polyglot.Upload()
+    utxos = [Unspent(amount=uploader.fresh_utxo_amount(), confirmations=1, txid='%064x' % i, txindex=0)
+             for i in range(args.txs)]
+    jobs = [(os.urandom(args.size), utxo) for utxo in utxos]
+
+    print('{} txs, {} bytes each, {} cores'.format(args.txs, args.size, os.cpu_count()))
+    print('{:>10} {:>10} {:>10} {:>10}'.format('processes', 'seconds', 'txs/s', 'speedup'))
+    baseline = None
+    expected = None
+    for processes in args.processes:
+        start = time.perf_counter()
+        rawtxs, txids = uploader.build_rawtxs('bcat_part_create_from_binary', jobs, max_processes=processes)
+        elapsed = time.perf_counter() - start
+        if expected is None:
+            expected, baseline = txids, elapsed
+        assert txids == expected
+        print('{:>10} {:>10.2f} {:>10.0f} {:>9.1f}x'.format(processes, elapsed, args.txs / elapsed,
+                                                          baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
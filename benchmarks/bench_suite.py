@@ -0,0 +1,233 @@
+"""End-to-end benchmarks of the upload and download hot paths against an in-memory FakeChain.
+
+Each case runs in its own process. Its setup (random data, and for downloads the whole upload to the
+FakeChain) is done before anything is measured, and the memory a case needs is the peak traced by
+tracemalloc while the measured work alone runs once more (peak RSS, mostly setup, is only reported).
+Results are compared with benchmarks/baseline.json. A case making more requests than its baseline, or
+needing more than --tolerance more memory, is flagged as a regression (exit status 1). Throughput depends
+too much on the machine to gate on by default - pass --check-throughput to also flag cases more than
+--tolerance slower (in MB/s) than a baseline recorded on the same machine.
+
+    $ python benchmarks/bench_suite.py                  # 1 MB, 100 MB and 300 MB files
+    $ python benchmarks/bench_suite.py --sizes 1        # quick run
+    $ python benchmarks/bench_suite.py --save-baseline  # record the current results as the baseline
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from bitsv.network.meta import Unspent
+from bitsv import op_return
+
+import polyglot
+from polyglot.bitcom import BCATPART
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+MB = 1000 * 1000
+PART_SIZE = 90_000
+# Growth in peak memory that is never a regression (cases that allocate next to nothing vary by more than
+# --tolerance)
+PEAK_SLACK_MB = 1
+
+
+def random_binary(size, seed=0):
+    """size reproducible pseudo-random bytes (built a MB at a time)"""
+    rng = random.Random(seed)
+    blocks = (min(MB, size - offset) for offset in range(0, size, MB))
+    return b''.join(rng.getrandbits(8 * length).to_bytes(length, 'little') for length in blocks)
+
+
+def fresh_utxos(uploader, n):
+    return [Unspent(amount=uploader.fresh_utxo_amount(), confirmations=1, txid='%064x' % i, txindex=0)
+            for i in range(n)]
+
+
+def traced_peak(func):
+    """calls func once with tracemalloc on - returns the peak of the memory allocated meanwhile, in MB"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / MB
+    finally:
+        tracemalloc.stop()
+
+
+def repeat(func, min_seconds=1.0):
+    """calls func until min_seconds have passed - returns (number of calls, seconds)"""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return calls, elapsed
+
+
+class Sink(io.RawIOBase):
+    """Counts and discards what download_bcat writes"""
+    def __init__(self):
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def bench_pushdata():
+    script = (b'\x00\x6a' + op_return.create_pushdata([(BCATPART, 'utf-8'),
+                                                       (random_binary(PART_SIZE), 'bytes')])).hex()
+    parse = lambda: polyglot.Download.pushdata_from_script(script)
+    calls, seconds = repeat(parse)
+    return {'bytes': calls * PART_SIZE, 'seconds': seconds, 'ops': calls, 'peak_mb': traced_peak(parse)}
+
+
+def bench_b_rawtx():
+    uploader = polyglot.Upload()
+    binary = random_binary(PART_SIZE)
+    utxos = fresh_utxos(uploader, 1)
+    create = lambda: uploader.b_create_rawtx_from_binary(binary, 'application/octet-stream', utxos=utxos)
+    calls, seconds = repeat(create)
+    return {'bytes': calls * PART_SIZE, 'seconds': seconds, 'ops': calls, 'peak_mb': traced_peak(create)}
+
+
+def bench_bcat_parts(size):
+    uploader = polyglot.Upload()
+    binary = random_binary(size)
+    utxos = fresh_utxos(uploader, uploader.fresh_utxos_needed(size))
+    start = time.perf_counter()
+    rawtxs = uploader.bcat_parts_create_from_binary(binary, utxos=utxos)
+    seconds = time.perf_counter() - start
+    ops = len(rawtxs)
+    del rawtxs
+    peak_mb = traced_peak(lambda: uploader.bcat_parts_create_from_binary(binary, utxos=utxos))
+    return {'bytes': size, 'seconds': seconds, 'ops': ops, 'peak_mb': peak_mb}
+
+
+def upload_to_fake_chain(size):
+    """returns (FakeChain, linker txid) for a BCAT file of size random bytes"""
+    chain = polyglot.FakeChain()
+    uploader = polyglot.Upload(backend=chain)
+    num_utxos = uploader.fresh_utxos_needed(size)
+    chain.fund(uploader.address, uploader.fresh_utxo_amount(), count=num_utxos)
+    utxos = uploader.filter_utxos_for_bcat()
+    rawtxs = uploader.bcat_parts_create_from_binary(random_binary(size), utxos=utxos)
+    txids = [chain.send_rawtx(rawtx) for rawtx in rawtxs]
+    linker = chain.send_rawtx(uploader.bcat_linker_create_from_txids(txids, 'application/octet-stream', ' ', ' ',
+                                                                    utxos=utxos[-1:]))
+    chain.mine()
+    chain.calls.clear()
+    return chain, linker
+
+
+def bench_linker_parse(size):
+    chain, linker = upload_to_fake_chain(size)
+    downloader = polyglot.Download(backend=chain)
+    scripts = downloader.script_views_from_txid(linker)
+    num_parts = len(downloader.bcat_linker_fields_from_scripts(scripts)['parts'])
+    parse = lambda: downloader.bcat_linker_fields_from_scripts(scripts)
+    calls, seconds = repeat(parse)
+    return {'bytes': calls * sum(len(script) for script in scripts), 'seconds': seconds, 'ops': calls,
+            'parts': num_parts, 'peak_mb': traced_peak(parse)}
+
+
+def bench_download_bcat(size):
+    chain, linker = upload_to_fake_chain(size)
+    sink = Sink()
+    start = time.perf_counter()
+    polyglot.Download(backend=chain).download_bcat(linker, sink)
+    seconds = time.perf_counter() - start
+    assert sink.size == size
+    requests = sum(chain.calls.values())
+    # a new Download, so nothing is served from the first one's cache
+    peak_mb = traced_peak(lambda: polyglot.Download(backend=chain).download_bcat(linker, Sink()))
+    return {'bytes': size, 'seconds': seconds, 'requests': requests, 'peak_mb': peak_mb}
+
+
+def cases(sizes):
+    """name -> (function, args)"""
+    result = {'pushdata_from_script': (bench_pushdata, ()),
+              'b_rawtx': (bench_b_rawtx, ())}
+    for size in sizes:
+        result['bcat_parts_{}mb'.format(size)] = (bench_bcat_parts, (size * MB,))
+    for size in sizes:
+        result['linker_parse_{}mb'.format(size)] = (bench_linker_parse, (size * MB,))
+    for size in sizes:
+        result['download_bcat_{}mb'.format(size)] = (bench_download_bcat, (size * MB,))
+    return result
+
+
+def run_case(name, sizes):
+    func, args = cases(sizes)[name]
+    result = func(*args)
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1 if sys.platform == 'darwin' else 1024
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / MB
+    result['mb_per_s'] = result['bytes'] / MB / result['seconds']
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 300], help='file sizes in MB')
+    parser.add_argument('--cases', nargs='+', default=None, help='only run these cases')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction of its baseline peak memory (and MB/s with --check-throughput) a case may '
+                             'gain (lose) before it is a regression')
+    parser.add_argument('--check-throughput', action='store_true',
+                        help='also flag cases slower than their baseline (only meaningful on the machine the '
+                             'baseline was recorded on)')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to ' + BASELINE_PATH)
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return run_case(args.run, args.sizes)
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, 'r') as f:
+            baseline = json.load(f)
+    results = {}
+    regressions = []
+    print('{:<24} {:>10} {:>10} {:>10} {:>12} {:>10} {:>10}'.format('case', 'MB/s', 'baseline', 'peak MB',
+                                                                     'peak RSS MB', 'requests', 'ops'))
+    for name in args.cases or cases(args.sizes):
+        output = subprocess.run([sys.executable, __file__, '--run', name, '--sizes'] + [str(s) for s in args.sizes],
+                                check=True, stdout=subprocess.PIPE).stdout
+        result = results[name] = json.loads(output.decode('utf-8').splitlines()[-1])
+        base_result = baseline.get(name, {})
+        base = base_result.get('mb_per_s')
+        flag = ''
+        max_peak = base_result.get('peak_mb', float('inf')) * (1 + args.tolerance) + PEAK_SLACK_MB
+        if base_result and (result['peak_mb'] > max_peak or
+                            result.get('requests', 0) > base_result.get('requests', 0) or
+                            (args.check_throughput and result['mb_per_s'] < base * (1 - args.tolerance))):
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<24} {:>10.1f} {:>10} {:>10.1f} {:>12.0f} {:>10} {:>10}{}'.format(
+            name, result['mb_per_s'], '-' if base is None else '{:.1f}'.format(base), result['peak_mb'],
+            result['peak_rss_mb'], result.get('requests', '-'), result.get('ops', '-'), flag))
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to ' + BASELINE_PATH)
+    elif regressions:
+        print('regressions: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,5 +3,20 @@ import bitsv
 from polyglot.bitcom import B, C, BCAT, BCATPART, D, AIP,MAP
 from polyglot.upload import Upload
 from polyglot.download import Download
+from polyglot.backends import NetworkBackend, WhatsonchainBackend, FakeChain
+from polyglot.cache import TxCache
+from polyglot.decoder import Segment, register_protocol
+from polyglot.metrics import Metrics
+from polyglot.dedup import DedupIndex
+from polyglot.journal import UploadJournal, DownloadJournal
+from polyglot.utxos import UtxoTracker
+from polyglot.scanner import ScanIndex, ScanIndexBackend
+from polyglot.reader import BcatReader
+from polyglot.sniff import MetadataSniffer
+
+try:
+    from polyglot.aio import AsyncUpload, AsyncDownload
+except ImportError:  # aiohttp is optional (pip install polyglot-bitcoin[async])
+    pass
 
 __version__ = '0.0.3'
@@ -2,6 +2,8 @@
 
 import argparse
 import getpass
+import glob
+import os
 import sys
 import bitsv
 import polyglot
@@ -26,14 +28,110 @@ def get_wif_securely():
     return wif
 
 
+def expand_paths(paths, manifest=None):
+    """Expands files, directories (recursively) and glob patterns - plus the paths listed one per line in
+    a manifest file (blank lines and lines starting with # are skipped) - into a list of files"""
+    if manifest is not None:
+        with open(manifest, 'r') as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    files = []
+    for path in paths:
+        matches = sorted(glob.glob(path, recursive=True)) if glob.has_magic(path) else [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, names in os.walk(match):
+                    dirs.sort()
+                    files.extend(os.path.join(root, name) for name in sorted(names))
+            else:
+                files.append(match)
+    return files
+
+
+def download_main(argv):
+    parser = argparse.ArgumentParser(prog='polyglot-cli download',
+                                     description='Download B:// and BCAT:// files from Bitcoin SV.')
+    parser.add_argument('txids', nargs='+', metavar='txid', help='txid of a B:// tx or BCAT:// linker')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("-o", "--output", dest="output", default=None,
+                        help="file to write to (one txid only) - default: stream to stdout")
+    output.add_argument("-d", "--output-dir", dest="output_dir", default=None,
+                        help="directory to write each file to (named as in its tx, or by txid)")
+    parser.add_argument("--no-gunzip", action="store_false", dest="gunzip", default=True,
+                        help="Write gzip BCAT files as stored instead of decompressing them")
+    parser.add_argument("--resume", action="store_true", dest="resume", default=False,
+                        help="Continue interrupted BCAT downloads to a file (see Download.download_bcat)")
+    parser.add_argument("--workers", type=int, dest="workers", default=polyglot.download.DEFAULT_MAX_WORKERS,
+                        help="number of concurrent requests for BCAT parts")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=None,
+                        help="keep fetched transactions on disk here between runs")
+    parser.add_argument("--timings", action="store_true", dest="timings", default=False,
+                        help="Print the time spent in each stage to stderr when done")
+    parser.add_argument("--testnet", action="store_true", dest="testnet", default=False,
+                       help="Use Testnet")
+    parser.add_argument("--scaling-testnet", action="store_true", dest="scalingtestnet",
+                       default=False, help="Use Scaling Testnet")
+    args = parser.parse_args(argv)
+    if args.output is not None and len(args.txids) > 1:
+        parser.error('--output takes one txid - use --output-dir for several')
+
+    cache = polyglot.TxCache(directory=args.cache_dir) if args.cache_dir is not None else None
+    metrics = polyglot.Metrics() if args.timings else None
+    downloader = polyglot.Download(network=set_network(args), max_workers=args.workers, cache=cache,
+                                   metrics=metrics)
+    # one bulk request for all the B:// txs / BCAT:// linkers
+    downloader.rawtxs_from_txids(args.txids)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    for txid in args.txids:
+        if args.output is not None:
+            file = args.output
+        elif args.output_dir is not None:
+            file = args.output_dir
+        else:
+            file = sys.stdout.buffer
+        try:
+            downloader.download(txid, file, gunzip=args.gunzip, resume=args.resume)
+        except BrokenPipeError:
+            # the reader (e.g. head) has gone away
+            sys.stderr.close()
+            sys.exit(1)
+        if file is sys.stdout.buffer:
+            file.flush()
+    if metrics is not None:
+        print(metrics.report(), file=sys.stderr)
+
+
 def main():
-    parser = argparse.ArgumentParser(description='Upload a file to Bitcoin SV.')
-    parser.add_argument('file', help='filename')
+    if sys.argv[1:2] == ['download']:
+        return download_main(sys.argv[2:])
+    if sys.argv[1:2] == ['upload']:
+        del sys.argv[1]
+    parser = argparse.ArgumentParser(description='Upload a file to Bitcoin SV. '
+                                                 '(Run "polyglot-cli download -h" for downloading)')
+    parser.add_argument('paths', nargs='*', metavar='path',
+                        help='file, directory or glob pattern (more than one file uploads them as a batch)')
+    parser.add_argument("--manifest", dest="manifest", default=None,
+                        help="file listing paths to upload, one per line")
+    parser.add_argument("--jobs", type=int, dest="jobs", default=polyglot.upload.DEFAULT_MAX_WORKERS,
+                        help="number of files uploaded at once in a batch")
+    parser.add_argument("--zero-conf", action="store_true", dest="zero_conf", default=False,
+                        help="Spend unconfirmed split outputs instead of waiting for confirmation")
+    parser.add_argument("--compress", action="store_true", dest="compress", default=False,
+                        help="gzip compressible files uploaded via BCAT://")
+    parser.add_argument("--dedup-index", dest="dedup_index", default=None,
+                        help="SQLite index of content already uploaded (skips re-uploading it)")
+    parser.add_argument("--timings", action="store_true", dest="timings", default=False,
+                        help="Print the time spent in each stage to stderr when done")
     parser.add_argument("--testnet", action="store_true", dest="testnet", default=False,
                        help="Use Testnet")
     parser.add_argument("--scaling-testnet", action="store_true", dest="scalingtestnet",
                        default=False, help="Use Scaling Testnet")
     args = parser.parse_args()
+    if not args.paths and args.manifest is None:
+        parser.error('nothing to upload')
+    batch = (len(args.paths) != 1 or args.manifest is not None or os.path.isdir(args.paths[0])
+             or glob.has_magic(args.paths[0]))
+    files = expand_paths(args.paths, args.manifest)
     wif = get_wif_securely()
 
     try:
@@ -43,6 +141,30 @@ def main():
         print(f"'{wif}' is not a valid WIF format private key")
         sys.exit(1)
 
-    uploader = polyglot.Upload(wif, network=set_network(args))
-    txid = uploader.upload_easy(args.file)
-    print(txid)
+    dedup_index = polyglot.DedupIndex(args.dedup_index) if args.dedup_index is not None else None
+    metrics = polyglot.Metrics() if args.timings else None
+    uploader = polyglot.Upload(wif, network=set_network(args), dedup_index=dedup_index, metrics=metrics)
+    if not batch:
+        txid = uploader.upload_easy(files[0], zero_conf=args.zero_conf, compress=args.compress)
+        print(txid)
+        if metrics is not None:
+            print(metrics.report(), file=sys.stderr)
+        return
+
+    # print the manifest (path -> txid) as uploads complete
+    failed = 0
+    for file, result in uploader.upload_batch(files, zero_conf=args.zero_conf, compress=args.compress,
+                                              max_concurrent=args.jobs):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"{file}: upload failed: {result}", file=sys.stderr)
+        else:
+            print(f"{file}\t{result}", flush=True)
+    if metrics is not None:
+        print(metrics.report(), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""asyncio counterparts of Upload and Download (requires aiohttp: pip install polyglot-bitcoin[async])
+
+All requests go through one pooled aiohttp session, which AsyncUpload and AsyncDownload can share, and at
+most max_concurrency of them are in flight at once. Transactions are still built, signed and parsed by
+Upload / Download - only the network calls differ.
+"""
+import asyncio
+import os
+from collections import deque
+
+import aiohttp
+from bitsv.network.services.network import DEFAULT_TIMEOUT
+from bitsv.network.services.whatsonchain import woc_utxos_to_unspents
+
+from .backends import BULK_TX_LIMIT, WOC_API_URL
+from .download import DEFAULT_MAX_WORKERS, Download, GunzipStream
+from .rawtx import txid_from_rawtx
+from .upload import Upload
+
+
+class AsyncClient:
+    """Holds the (lazily created or shared) aiohttp session and the semaphore limiting requests in flight.
+    Use as 'async with' or call close() - a session passed in is left open for its owner to close"""
+    def __init__(self, network='main', max_concurrency=DEFAULT_MAX_WORKERS, session=None, api_url=None):
+        self.api_url = api_url if api_url is not None else WOC_API_URL.format(network)
+        self.max_concurrency = max_concurrency
+        self._session = session
+        self._owns_session = session is None
+        self._semaphore = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                                                  timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT))
+        return self._session
+
+    @property
+    def semaphore(self):
+        # created on first use so that it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def get_text(self, path):
+        async with self.semaphore, self.session.get(self.api_url + path) as r:
+            r.raise_for_status()
+            return await r.text()
+
+    async def get_json(self, path):
+        async with self.semaphore, self.session.get(self.api_url + path) as r:
+            r.raise_for_status()
+            return await r.json(content_type=None)
+
+    async def post_json(self, path, payload):
+        async with self.semaphore, self.session.post(self.api_url + path, json=payload) as r:
+            r.raise_for_status()
+            return await r.json(content_type=None)
+
+    async def close(self):
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncDownload(AsyncClient):
+    """Downloads B:// and BCAT:// content without blocking the event loop (see Download)"""
+    def __init__(self, network='main', max_concurrency=DEFAULT_MAX_WORKERS, cache=None, session=None,
+                 api_url=None):
+        super().__init__(network=network, max_concurrency=max_concurrency, session=session, api_url=api_url)
+        # parsing and the TxCache - its own (blocking) network calls are never used
+        self.downloader = Download(network=network, max_workers=1, cache=cache, api_url=self.api_url)
+        self.cache = self.downloader.cache
+
+    async def get_rawtx(self, txid, verify=True):
+        rawtx = bytes.fromhex((await self.get_text('/tx/{}/hex'.format(txid))).strip().strip('"'))
+        if verify and txid_from_rawtx(rawtx) != txid:
+            raise ValueError('rawtx returned for {} has txid {}'.format(txid, txid_from_rawtx(rawtx)))
+        return rawtx
+
+    async def get_rawtxs_bulk(self, txids, verify=True):
+        """As Download.get_rawtxs_bulk"""
+        try:
+            found = {tx['txid']: tx['hex'] for tx in await self.post_json('/txs/hex', {'txids': list(txids)})
+                     if tx.get('hex')}
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError, AttributeError):
+            found = {}
+        fallback = [txid for txid in txids if txid not in found]
+        fetched = dict(zip(fallback, await asyncio.gather(*(self.get_rawtx(txid, verify=verify)
+                                                            for txid in fallback))))
+        rawtxs = []
+        for txid in txids:
+            if txid in found:
+                rawtx = bytes.fromhex(found[txid])
+                if verify and txid_from_rawtx(rawtx) != txid:
+                    raise ValueError('rawtx returned for {} has txid {}'.format(txid, txid_from_rawtx(rawtx)))
+                rawtxs.append(rawtx)
+            else:
+                rawtxs.append(fetched[txid])
+        return rawtxs
+
+    async def rawtxs_from_txids(self, txids):
+        """returns {txid: rawtx} - uncached txids are fetched BULK_TX_LIMIT at a time, concurrently"""
+        result = {}
+        missing = []
+        for txid in txids:
+            rawtx = self.cache.get(txid)
+            if rawtx is not None:
+                result[txid] = rawtx
+            elif txid not in result:
+                missing.append(txid)
+                result[txid] = None
+        batches = [missing[i:i + BULK_TX_LIMIT] for i in range(0, len(missing), BULK_TX_LIMIT)]
+        for batch, rawtxs in zip(batches, await asyncio.gather(*(self.get_rawtxs_bulk(batch)
+                                                                 for batch in batches))):
+            for txid, rawtx in zip(batch, rawtxs):
+                self.cache.put(txid, rawtx)
+                result[txid] = rawtx
+        return result
+
+    async def script_views_from_txid(self, txid):
+        return (await self.script_views_from_txids([txid]))[txid]
+
+    async def script_views_from_txids(self, txids):
+        return {txid: Download.script_views_from_rawtx(rawtx)
+                for txid, rawtx in (await self.rawtxs_from_txids(txids)).items()}
+
+    async def b_fields_from_txid(self, txid):
+        return self.downloader.b_fields_from_scripts(await self.script_views_from_txid(txid))
+
+    async def download_b(self, txid, file):
+        """Writes the B:// file at txid to 'file' (a path or a writable binary file-like object) - in a
+        worker thread, so the event loop never waits on disk"""
+        fields = await self.b_fields_from_txid(txid)
+        if not fields:
+            raise ValueError('b tx not found')
+        loop = asyncio.get_event_loop()
+        if hasattr(file, 'write'):
+            await loop.run_in_executor(None, file.write, fields['data'])
+        else:
+            await loop.run_in_executor(None, self.downloader.binary_to_file, fields['data'], os.path.abspath(file))
+        return fields
+
+    async def bcat_linker_fields_from_txid(self, txid):
+        return self.downloader.bcat_linker_fields_from_scripts(await self.script_views_from_txid(txid))
+
+    async def bcat_part_binaries_from_txids(self, txids):
+        scripts = await self.script_views_from_txids(txids)
+        return [self.downloader.bcat_part_binary_from_scripts(scripts[txid]) for txid in txids]
+
+    async def bcat_chunks_from_txids(self, txids):
+        """Async generator over the binary of each BCAT part in order - fetching up to max_concurrency
+        batches of BULK_TX_LIMIT ahead"""
+        batches = [txids[i:i + BULK_TX_LIMIT] for i in range(0, len(txids), BULK_TX_LIMIT)]
+        pending = deque()
+        try:
+            for batch in batches:
+                pending.append(asyncio.ensure_future(self.bcat_part_binaries_from_txids(batch)))
+                if len(pending) >= self.max_concurrency:
+                    for binary in await pending.popleft():
+                        yield binary
+            while pending:
+                for binary in await pending.popleft():
+                    yield binary
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def bcat_chunks_from_fields(self, fields, gunzip=True):
+        """As Download.bcat_chunks_from_fields"""
+        if not (gunzip and fields['flag'] in ('gzip', 'nested-gzip')):
+            async for chunk in self.bcat_chunks_from_txids(fields['parts']):
+                yield chunk
+            return
+        fields['flag'] = fields['flag'].replace('zip', 'unzipped')
+        stream = GunzipStream()
+        async for chunk in self.bcat_chunks_from_txids(fields['parts']):
+            for data in stream.decompress(chunk):
+                yield data
+        stream.close()
+
+    async def download_bcat(self, txid, file, gunzip=True):
+        """Streams the BCAT file at txid to 'file' (a path or a writable binary file-like object). The file
+        is opened, written and closed in a worker thread while the next parts are fetched"""
+        fields = await self.bcat_linker_fields_from_txid(txid)
+        if not fields:
+            raise ValueError('bcat tx not found')
+        loop = asyncio.get_event_loop()
+        f = file if hasattr(file, 'write') else await loop.run_in_executor(None, open, file, 'wb')
+        try:
+            async for data in self.bcat_chunks_from_fields(fields, gunzip=gunzip):
+                await loop.run_in_executor(None, f.write, data)
+        finally:
+            if f is not file:
+                await loop.run_in_executor(None, f.close)
+        return fields
+
+
+class AsyncUpload(AsyncClient):
+    """Uploads B:// and BCAT:// content without blocking the event loop (see Upload).
+    Extra keyword arguments are passed on to the Upload used to build and sign the txs"""
+    def __init__(self, wif=None, network='main', max_concurrency=DEFAULT_MAX_WORKERS, session=None, api_url=None,
+                 **kwargs):
+        super().__init__(network=network, max_concurrency=max_concurrency, session=session, api_url=api_url)
+        self.uploader = Upload(wif=wif, network=network, **kwargs)
+
+    async def fetch_unspents(self):
+        info, utxos = await asyncio.gather(self.get_json('/chain/info'),
+                                           self.get_json('/address/{}/unspent'.format(self.uploader.address)))
+        return woc_utxos_to_unspents(utxos, info['blocks'])
+
+    async def get_unspents(self):
+        """As Upload.get_unspents - the UtxoTracker is refreshed asynchronously when stale"""
+        tracker = self.uploader.utxo_tracker
+        if tracker.is_stale():
+            tracker.refresh(await self.fetch_unspents())
+        return tracker.get()
+
+    async def filter_utxos_for_bcat(self, min_confirmations=None):
+        await self.get_unspents()
+        return self.uploader.filter_utxos_for_bcat(min_confirmations)
+
+    async def send_rawtx(self, rawtx):
+        """Broadcasts rawtx and records it in the UtxoTracker - returns its txid"""
+        await self.post_json('/tx/raw', {'txhex': rawtx})
+        txid = self.uploader.calculate_txid(rawtx)
+        self.uploader.utxo_tracker.record_rawtx(rawtx, txid)
+        return txid
+
+    async def send_rawtxs(self, rawtxs):
+        """Broadcasts independent rawtxs concurrently - returns their txids in order"""
+        return list(await asyncio.gather(*(self.send_rawtx(rawtx) for rawtx in rawtxs)))
+
+    async def upload_b(self, file, media_type=None, encoding=None, file_name=None, utxos=None):
+        """As Upload.upload_b - the file is read, sniffed and signed in a worker thread. Returns txid"""
+        if utxos is None:
+            utxos = await self.filter_utxos_for_bcat()
+        rawtx = await asyncio.get_event_loop().run_in_executor(
+            None, self.uploader.b_create_rawtx_from_file, file, media_type, encoding, file_name, utxos)
+        return await self.send_rawtx(rawtx)
+
+    def bcat_create_from_file(self, file, media_type, encoding, file_name, utxos, compress=False):
+        """Builds and signs the parts and linker for file (reading it once, and sniffing whichever of
+        media_type, encoding and file_name are None) - returns (list of part rawtx, linker rawtx)"""
+        uploader = self.uploader
+        binary = uploader.file_to_binary(file)
+        media_type, encoding, file_name = uploader.file_metadata(file, binary, media_type, encoding, file_name)
+        flags = ' '
+        if compress and uploader.is_compressible(media_type):
+            compressed = uploader.gzip_binary(binary)
+            if len(compressed) < len(binary):
+                binary, flags = compressed, 'gzip'
+        rawtxs = uploader.bcat_parts_create_from_binary(binary, utxos=utxos)
+        txids = [uploader.calculate_txid(rawtx) for rawtx in rawtxs]
+        return rawtxs, uploader.bcat_linker_create_from_txids(txids, media_type, encoding, file_name, flags=flags,
+                                                              utxos=utxos[-1:])
+
+    async def upload_bcat(self, file, media_type=None, encoding=None, file_name=None, utxos=None, compress=False):
+        """As Upload.upload_bcat - the file is read, sniffed and its parts signed in a worker thread, then
+        broadcast concurrently. Returns txid of linker"""
+        if utxos is None:
+            utxos = await self.filter_utxos_for_bcat()
+        rawtxs, linker_rawtx = await asyncio.get_event_loop().run_in_executor(
+            None, self.bcat_create_from_file, file, media_type, encoding, file_name, utxos, compress)
+        await self.send_rawtxs(rawtxs)
+        return await self.send_rawtx(linker_rawtx)
+
+    async def upload(self, file, compress=False):
+        """B:// or BCAT:// depending on filesize (as upload_easy, but the 'Fresh' utxos must already exist)"""
+        if self.uploader.fits_in_b_tx(os.path.getsize(file)):
+            return await self.upload_b(file)
+        return await self.upload_bcat(file, compress=compress)
@@ -0,0 +1,198 @@
+import os
+import threading
+from collections import Counter
+
+import requests
+from bitsv.format import address_to_public_key_hash
+from bitsv.network.meta import Unspent
+from bitsv.network.services.network import DEFAULT_TIMEOUT
+from bitsv.network.services.whatsonchain import woc_utxos_to_unspents
+from bitsv.utils import int_to_varint
+
+from .rawtx import Output, deserialize_rawtx, txid_from_rawtx
+
+# Whatsonchain api (serves /tx/<txid>/hex and the multi-tx /txs/hex) and the most txids it accepts per bulk request
+WOC_API_URL = 'https://api.whatsonchain.com/v1/bsv/{}'
+BULK_TX_LIMIT = 20
+
+# Connections kept open to the api
+DEFAULT_POOL_SIZE = 8
+
+
+class NetworkBackend:
+    """What Upload and Download need from the network - subclass this to use your own node or service
+    (pass backend=... to Upload / Download)"""
+    def get_unspents(self, address):
+        """returns the list of Unspent for address"""
+        raise NotImplementedError
+
+    def get_transactions(self, address):
+        """returns the txids of every tx paying to or spending from address"""
+        raise NotImplementedError
+
+    def get_rawtx(self, txid):
+        """returns the raw transaction (bytes) for txid"""
+        raise NotImplementedError
+
+    def get_rawtxs(self, txids):
+        """returns the raw transactions (bytes) for txids in the same order - override if the service
+        can fetch several in one request"""
+        return [self.get_rawtx(txid) for txid in txids]
+
+    def send_rawtx(self, rawtx):
+        """broadcasts rawtx (hex) - returns its txid"""
+        raise NotImplementedError
+
+
+class WhatsonchainBackend(NetworkBackend):
+    """The whatsonchain api (or anything serving the same endpoints at api_url) over one pooled
+    requests session"""
+    def __init__(self, network='main', api_url=None, pool_size=DEFAULT_POOL_SIZE):
+        self.api_url = api_url if api_url is not None else WOC_API_URL.format(network)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(pool_size, 1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_unspents(self, address):
+        r = self.session.get(self.api_url + '/chain/info', timeout=DEFAULT_TIMEOUT)
+        r.raise_for_status()
+        block_height = r.json()['blocks']
+        r = self.session.get(self.api_url + '/address/{}/unspent'.format(address), timeout=DEFAULT_TIMEOUT)
+        r.raise_for_status()
+        return woc_utxos_to_unspents(r.json(), block_height)
+
+    def get_transactions(self, address):
+        r = self.session.get(self.api_url + '/address/{}/history'.format(address), timeout=DEFAULT_TIMEOUT)
+        r.raise_for_status()
+        return [tx['tx_hash'] for tx in r.json()]
+
+    def get_rawtx(self, txid):
+        r = self.session.get(self.api_url + '/tx/{}/hex'.format(txid), timeout=DEFAULT_TIMEOUT)
+        r.raise_for_status()
+        return bytes.fromhex(r.text.strip().strip('"'))
+
+    def get_rawtxs(self, txids):
+        """Fetches up to BULK_TX_LIMIT raw transactions in a single request to the multi-tx endpoint.
+        Falls back to one request per txid for any the bulk request does not return"""
+        try:
+            r = self.session.post(self.api_url + '/txs/hex', json={'txids': list(txids)}, timeout=DEFAULT_TIMEOUT)
+            r.raise_for_status()
+            found = {tx['txid']: tx['hex'] for tx in r.json() if tx.get('hex')}
+        except (requests.RequestException, ValueError, KeyError, TypeError, AttributeError):
+            found = {}
+        return [bytes.fromhex(found[txid]) if txid in found else self.get_rawtx(txid) for txid in txids]
+
+    def send_rawtx(self, rawtx):
+        r = self.session.post(self.api_url + '/tx/raw', json={'txhex': rawtx}, timeout=DEFAULT_TIMEOUT)
+        r.raise_for_status()
+        return r.json()
+
+
+class FakeChain(NetworkBackend):
+    """An in-memory chain for tests and benchmarks - no network involved.
+
+    Broadcast txs are checked against the utxo set (inputs must exist and be unspent and outputs may not
+    exceed inputs - scripts and signatures are not checked) and wait in the mempool until mine() is called.
+    fund() creates coins out of thin air. Every call is counted in 'calls'.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.height = 0
+        self.txs = {}  # txid -> rawtx (bytes)
+        self.heights = {}  # txid -> height of the block it was mined in
+        self.utxos = {}  # (txid, txindex) -> Output
+        self.calls = Counter()
+
+    @staticmethod
+    def p2pkh_script(address):
+        return b'\x76\xa9\x14' + address_to_public_key_hash(address) + b'\x88\xac'
+
+    def fund(self, address, amount, count=1, confirmed=True):
+        """Pays count outputs of amount satoshis to address (mining them if confirmed) - returns the txid"""
+        script = self.p2pkh_script(address)
+        output = amount.to_bytes(8, 'little') + bytes([len(script)]) + script
+        rawtx = (b'\x01\x00\x00\x00' +
+                 b'\x01' + os.urandom(32) + b'\xff\xff\xff\xff' + b'\x00' + b'\xff\xff\xff\xff' +
+                 int_to_varint(count) + output * count +
+                 b'\x00\x00\x00\x00')
+        with self._lock:
+            txid = self._add(rawtx)
+            if confirmed:
+                self.mine()
+        return txid
+
+    def mine(self, blocks=1):
+        """Mines the mempool into the next block (and then blocks - 1 empty ones)"""
+        with self._lock:
+            self.height += blocks
+            for txid in self.txs:
+                if txid not in self.heights:
+                    self.heights[txid] = self.height - blocks + 1
+
+    def mempool(self):
+        with self._lock:
+            return [txid for txid in self.txs if txid not in self.heights]
+
+    def _add(self, rawtx):
+        txid = txid_from_rawtx(rawtx)
+        _, outputs = deserialize_rawtx(rawtx)
+        self.txs[txid] = rawtx
+        for txindex, output in enumerate(outputs):
+            self.utxos[(txid, txindex)] = Output(output.amount, bytes(output.script))
+        return txid
+
+    def get_unspents(self, address):
+        self.calls['get_unspents'] += 1
+        script = self.p2pkh_script(address)
+        with self._lock:
+            unspents = []
+            for (txid, txindex), output in self.utxos.items():
+                if output.script == script:
+                    height = self.heights.get(txid)
+                    confirmations = 0 if height is None else self.height - height + 1
+                    unspents.append(Unspent(amount=output.amount, confirmations=confirmations, txid=txid,
+                                            txindex=txindex))
+        return sorted(unspents, key=lambda utxo: (-utxo.confirmations, utxo.amount))
+
+    def get_transactions(self, address):
+        self.calls['get_transactions'] += 1
+        script = self.p2pkh_script(address)
+        with self._lock:
+            txs = {txid: deserialize_rawtx(rawtx) for txid, rawtx in self.txs.items()}
+        return [txid for txid, (inputs, outputs) in txs.items()
+                if any(output.script == script for output in outputs) or
+                any(txin.txid in txs and txs[txin.txid][1][txin.txindex].script == script for txin in inputs)]
+
+    def get_rawtx(self, txid):
+        self.calls['get_rawtx'] += 1
+        with self._lock:
+            if txid not in self.txs:
+                raise ValueError('tx {} not found'.format(txid))
+            return self.txs[txid]
+
+    def get_rawtxs(self, txids):
+        self.calls['get_rawtxs'] += 1
+        with self._lock:
+            missing = [txid for txid in txids if txid not in self.txs]
+            if missing:
+                raise ValueError('tx {} not found'.format(missing[0]))
+            return [self.txs[txid] for txid in txids]
+
+    def send_rawtx(self, rawtx):
+        self.calls['send_rawtx'] += 1
+        rawtx = bytes.fromhex(rawtx) if isinstance(rawtx, str) else bytes(rawtx)
+        txid = txid_from_rawtx(rawtx)
+        inputs, outputs = deserialize_rawtx(rawtx)
+        with self._lock:
+            if txid in self.txs:
+                return txid
+            spent = [(txin.txid, txin.txindex) for txin in inputs]
+            if len(set(spent)) != len(spent) or any(outpoint not in self.utxos for outpoint in spent):
+                raise ValueError('tx {} spends a missing or already spent output'.format(txid))
+            if sum(output.amount for output in outputs) > sum(self.utxos[outpoint].amount for outpoint in spent):
+                raise ValueError('tx {} spends more than its inputs'.format(txid))
+            for outpoint in spent:
+                del self.utxos[outpoint]
+            self._add(rawtx)
+        return txid
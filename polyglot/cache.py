@@ -0,0 +1,126 @@
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_MEMORY = 64 * 1024 * 1024  # bytes
+DEFAULT_MAX_DISK = 1024 * 1024 * 1024  # bytes
+
+
+class TxCache:
+    """Content-addressed cache of raw transactions (bytes) keyed by txid.
+
+    Transactions never change once they have a txid so entries never need invalidating - only evicting.
+    Holds an in-memory LRU (bounded by max_memory bytes) and optionally an on-disk store in 'directory'
+    (bounded by max_disk bytes) which survives restarts. Least recently used entries are evicted first.
+
+    Safe to share between threads (e.g. the Download thread pool)
+    """
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY, directory=None, max_disk=DEFAULT_MAX_DISK):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.max_disk = max_disk
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # txid -> rawtx
+        self._memory_size = 0
+        self._disk = OrderedDict()  # txid -> size
+        self._disk_size = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    def _path(self, txid):
+        return os.path.join(self.directory, txid)
+
+    def _load_disk_index(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, txid, size in sorted(entries):
+            self._disk[txid] = size
+            self._disk_size += size
+
+    def get(self, txid):
+        """returns the rawtx (bytes) for txid or None if not cached"""
+        with self._lock:
+            if txid in self._memory:
+                self._memory.move_to_end(txid)
+                return self._memory[txid]
+            if txid not in self._disk:
+                return None
+            self._disk.move_to_end(txid)
+        try:
+            with open(self._path(txid), 'rb') as f:
+                rawtx = f.read()
+            os.utime(self._path(txid))
+        except FileNotFoundError:
+            with self._lock:
+                self._disk_size -= self._disk.pop(txid, 0)
+            return None
+        with self._lock:
+            self._put_memory(txid, rawtx)
+        return rawtx
+
+    def put(self, txid, rawtx):
+        rawtx = bytes(rawtx)
+        with self._lock:
+            self._put_memory(txid, rawtx)
+        if self.directory is not None:
+            self._put_disk(txid, rawtx)
+
+    def _put_memory(self, txid, rawtx):
+        if len(rawtx) > self.max_memory:
+            return
+        if txid in self._memory:
+            self._memory_size -= len(self._memory.pop(txid))
+        self._memory[txid] = rawtx
+        self._memory_size += len(rawtx)
+        while self._memory_size > self.max_memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _put_disk(self, txid, rawtx):
+        if len(rawtx) > self.max_disk:
+            return
+        # write then rename so that a crash never leaves a truncated entry behind
+        tmp = self._path(txid) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(rawtx)
+        os.replace(tmp, self._path(txid))
+        evicted = []
+        with self._lock:
+            if txid in self._disk:
+                self._disk_size -= self._disk.pop(txid)
+            self._disk[txid] = len(rawtx)
+            self._disk_size += len(rawtx)
+            while self._disk_size > self.max_disk:
+                evicted_txid, evicted_size = self._disk.popitem(last=False)
+                self._disk_size -= evicted_size
+                evicted.append(evicted_txid)
+        for evicted_txid in evicted:
+            try:
+                os.remove(self._path(evicted_txid))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            txids = list(self._disk)
+            self._disk.clear()
+            self._disk_size = 0
+        for txid in txids:
+            try:
+                os.remove(self._path(txid))
+            except FileNotFoundError:
+                pass
+
+    def __contains__(self, txid):
+        with self._lock:
+            return txid in self._memory or txid in self._disk
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memory.keys() | self._disk.keys())
@@ -0,0 +1,116 @@
+"""Decodes the Bitcom protocols in an OP_RETURN output in one pass (see Download.decode_txid).
+
+The pushes of an output are split into segments at '|' pushes (e.g. B ... | MAP ... | AIP ...) and each
+segment is handed to the handler registered for its prefix. Register handlers for more protocols with
+register_protocol.
+"""
+from collections import namedtuple
+
+from .bitcom import AIP, B, BCAT, BCATPART, D, MAP
+
+PIPE = b'|'
+
+# One decoded Bitcom segment: protocol name, index of the output it was found in, and the handler's fields
+# (None if the segment was too short or malformed for its protocol)
+Segment = namedtuple('Segment', ('protocol', 'txindex', 'fields'))
+
+# prefix (bytes) -> (protocol name, handler)
+PROTOCOLS = {}
+
+
+def register_protocol(prefix, name, handler):
+    """handler(pushes) is given the pushes of a segment after the prefix (memoryviews) and returns a dict
+    of fields - raising IndexError or ValueError if they do not make sense for the protocol"""
+    PROTOCOLS[prefix.encode('utf-8') if isinstance(prefix, str) else bytes(prefix)] = (name, handler)
+
+
+def text(push):
+    return bytes(push).decode('utf-8', 'replace')
+
+
+def split_segments(data):
+    """splits pushdata (as from Download.pushdata_views_from_script) into lists of pushes at '|' pushes.
+    A leading OP_FALSE (empty push) is dropped"""
+    if data and len(data[0]) == 0:
+        data = data[1:]
+    segments = [[]]
+    for push in data:
+        if push == PIPE:
+            segments.append([])
+        else:
+            segments[-1].append(push)
+    return [segment for segment in segments if segment]
+
+
+def decode_pushdata(data, txindex=0):
+    """returns a list of Segment for the Bitcom protocols in one output's pushdata"""
+    segments = []
+    for segment in split_segments(data):
+        protocol = PROTOCOLS.get(bytes(segment[0]))
+        if protocol is None:
+            continue
+        name, handler = protocol
+        try:
+            fields = handler(segment[1:])
+        except (IndexError, ValueError):
+            fields = None
+        segments.append(Segment(name, txindex, fields))
+    return segments
+
+
+def decode_b(pushes):
+    """data is a memoryview into the rawtx"""
+    fields = {'data': pushes[0], 'mediatype': text(pushes[1])}
+    if len(pushes) > 2:
+        fields['encoding'] = text(pushes[2])
+    if len(pushes) > 3:
+        fields['name'] = text(pushes[3])
+    return fields
+
+
+def decode_bcat(pushes):
+    if len(pushes) < 5:
+        raise IndexError('BCAT linker needs info, media type, encoding, name and flag')
+    return {'info': text(pushes[0]), 'mediatype': text(pushes[1]), 'encoding': text(pushes[2]),
+            'name': text(pushes[3]), 'flag': text(pushes[4]), 'parts': [push.hex() for push in pushes[5:]]}
+
+
+def decode_bcat_part(pushes):
+    """data is a memoryview into the rawtx"""
+    return {'data': pushes[0]}
+
+
+def decode_map(pushes):
+    """MAP SET <key> <value> ..., MAP ADD <key> <value> ... or MAP DELETE <key> ..."""
+    action = text(pushes[0])
+    args = [text(push) for push in pushes[1:]]
+    if action == 'SET':
+        if len(args) % 2:
+            raise ValueError('MAP SET needs key value pairs')
+        return {'action': action, 'data': dict(zip(args[::2], args[1::2]))}
+    if action == 'ADD':
+        return {'action': action, 'key': args[0], 'values': args[1:]}
+    if action in ('DELETE', 'REMOVE'):
+        return {'action': action, 'keys': args}
+    raise ValueError('unknown MAP action ' + action)
+
+
+def decode_aip(pushes):
+    """AIP <algorithm> <address> <signature> [<index of a signed push> ...]"""
+    return {'algorithm': text(pushes[0]), 'address': text(pushes[1]), 'signature': text(pushes[2]),
+            'indexes': [int(text(push)) for push in pushes[3:]]}
+
+
+def decode_d(pushes):
+    """D <key> <value> <type> <sequence>"""
+    return {'key': text(pushes[0]), 'value': text(pushes[1]), 'type': text(pushes[2]),
+            'sequence': int(text(pushes[3])) if len(pushes) > 3 else None}
+
+
+# C:// shares the B:// prefix
+register_protocol(B, 'B', decode_b)
+register_protocol(BCAT, 'BCAT', decode_bcat)
+register_protocol(BCATPART, 'BCATPART', decode_bcat_part)
+register_protocol(MAP, 'MAP', decode_map)
+register_protocol(AIP, 'AIP', decode_aip)
+register_protocol(D, 'D', decode_d)
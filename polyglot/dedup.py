@@ -0,0 +1,83 @@
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the blocks a file is read in while hashing it
+HASH_BLOCK_SIZE = 1024 * 1024  # bytes
+
+
+def sha256_file(path, block_size=HASH_BLOCK_SIZE):
+    """returns the sha256 (hex) of the file at path - read a block at a time so memory use stays flat"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def sha256_chunks(binary, chunk_size, max_workers=1):
+    """returns the sha256 (hex) of each chunk_size piece of binary, in order. hashlib releases the GIL
+    while hashing so the chunks are hashed in parallel across max_workers threads"""
+    binary = memoryview(binary)
+    chunks = [binary[i:i + chunk_size] for i in range(0, len(binary), chunk_size)]
+
+    def digest(chunk):
+        return hashlib.sha256(chunk).hexdigest()
+
+    if max_workers <= 1 or len(chunks) <= 1:
+        return [digest(chunk) for chunk in chunks]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(digest, chunks))
+
+
+class DedupIndex:
+    """Local SQLite index of content already on chain, keyed by sha256.
+
+    Maps whole files (with their media type) to the txid of their B:// tx or BCAT:// linker, and BCAT part
+    data to the txid of the part carrying it - so the same content is never paid for twice.
+    Only content that was broadcast successfully is added. Pass path=':memory:' for a throwaway index.
+
+    Safe to share between threads
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (sha256 TEXT NOT NULL, media_type TEXT NOT NULL, '
+                             'protocol TEXT NOT NULL, txid TEXT NOT NULL, PRIMARY KEY (sha256, media_type))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS parts (sha256 TEXT PRIMARY KEY, length INTEGER NOT NULL, '
+                             'txid TEXT NOT NULL)')
+
+    def get_file(self, sha256, media_type):
+        """returns the txid of the B:// tx or BCAT:// linker for this file or None"""
+        with self._lock:
+            row = self._db.execute('SELECT txid FROM files WHERE sha256 = ? AND media_type = ?',
+                                   (sha256, media_type)).fetchone()
+        return row[0] if row else None
+
+    def add_file(self, sha256, media_type, protocol, txid):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (sha256, media_type, protocol, txid))
+
+    def get_parts(self, hashes):
+        """returns {sha256: txid} for those of hashes already carried by a BCAT part"""
+        found = {}
+        hashes = list(set(hashes))
+        with self._lock:
+            # stay well under SQLite's limit on the number of query parameters
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                found.update(self._db.execute('SELECT sha256, txid FROM parts WHERE sha256 IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch))
+        return found
+
+    def add_parts(self, parts):
+        """parts is an iterable of (sha256, length, txid)"""
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO parts VALUES (?, ?, ?)', parts)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,12 +1,94 @@
-import gzip
-
-from bitsv.network import NetworkAPI
+import hashlib
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from .backends import BULK_TX_LIMIT, WhatsonchainBackend
 from .bitcom import B, C, BCAT, BCATPART, D, AIP, MAP
+from .cache import TxCache
+from .decoder import decode_pushdata
+from .journal import DownloadJournal
+from .metrics import NULL_METRICS
+from .rawtx import deserialize_rawtx, txid_from_rawtx
+
+B_BYTES = B.encode('utf-8')
+BCAT_BYTES = BCAT.encode('utf-8')
+BCATPART_BYTES = BCATPART.encode('utf-8')
+
+# zlib wbits for a gzip header / trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Largest piece of decompressed output produced at a time
+GUNZIP_CHUNK_SIZE = 1024 * 1024  # bytes
+
+# Appended to the output path of a resumable BCAT download for its DownloadJournal
+DOWNLOAD_JOURNAL_SUFFIX = '.bcatjournal'
+
+# Number of txids fetched concurrently for BCAT parts (set max_workers=1 to fetch one at a time)
+DEFAULT_MAX_WORKERS = 8
+
+
+class GunzipStream:
+    """Push-style incremental gunzip (see Download.gunzip_chunks) - feed it chunks with decompress() as
+    they arrive, then call close() to check the data did not end part way through a gzip member.
+    Zero bytes after a member are padding and skipped (as gzip.decompress does)"""
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(GZIP_WBITS)
+        self._started = False
+        self._member_ended = False
+
+    @staticmethod
+    def _strip_padding(chunk):
+        if not chunk or chunk[0] != 0:
+            return chunk
+        return bytes(chunk).lstrip(b'\x00')
+
+    def decompress(self, chunk):
+        """Yields the decompressed pieces (at most GUNZIP_CHUNK_SIZE bytes each) that chunk completes"""
+        if self._member_ended and not self._started:
+            chunk = self._strip_padding(chunk)
+        if not chunk:
+            return
+        self._started = True
+        while True:
+            data = self._decompressor.decompress(chunk, GUNZIP_CHUNK_SIZE)
+            if data:
+                yield data
+            if self._decompressor.eof:
+                self._member_ended = True
+                chunk = self._strip_padding(self._decompressor.unused_data)
+                self._decompressor = zlib.decompressobj(GZIP_WBITS)
+                self._started = bool(chunk)
+                if not chunk:
+                    break
+            else:
+                # a full piece of output means zlib may still hold more for the input already consumed
+                chunk = self._decompressor.unconsumed_tail
+                if not chunk and len(data) < GUNZIP_CHUNK_SIZE:
+                    break
+
+    def close(self):
+        if self._started:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
 
-class Download(NetworkAPI):
-    def __init__(self, network='main'):
-        super().__init__(network=network)
+
+class Download:
+    """Downloads B:// and BCAT:// content.
+
+    Transactions are fetched as raw bytes from the backend (whatsonchain at api_url by default - see
+    polyglot.backends) and parsed locally. They are cached by txid (see polyglot.TxCache) - by default in
+    memory only. Pass cache=TxCache(directory=...) to also keep them on disk between runs.
+    Pass metrics=Metrics() to separate time spent fetching from parsing (see polyglot.metrics).
+    All network access goes through the backend"""
+    def __init__(self, network='main', max_workers=DEFAULT_MAX_WORKERS, cache=None, api_url=None, backend=None,
+                 metrics=None):
+        self.network = network
+        if backend is None:
+            backend = WhatsonchainBackend(network=network, api_url=api_url, pool_size=max_workers)
+        self.backend = backend
+        self.max_workers = max_workers
+        self.cache = cache if cache is not None else TxCache()
+        self.metrics = metrics if metrics is not None else NULL_METRICS
 
     # UTILITIES
     @staticmethod
@@ -25,30 +107,128 @@ class Download(NetworkAPI):
         # FIXME - may not just work for any file
         return bytes.fromhex(hex)
 
+    def get_unspents(self, address):
+        return self.backend.get_unspents(address)
+
+    def broadcast_tx(self, tx_hex):
+        """returns the txid"""
+        return self.backend.send_rawtx(tx_hex)
+
+    def get_rawtx(self, txid, verify=True):
+        """Fetches the raw transaction (bytes) for txid - checking that it hashes to txid if verify=True"""
+        with self.metrics.stage('fetch') as stage:
+            rawtx = self.backend.get_rawtx(txid)
+            stage.add_bytes(len(rawtx))
+        if verify and txid_from_rawtx(rawtx) != txid:
+            raise ValueError('rawtx returned for {} has txid {}'.format(txid, txid_from_rawtx(rawtx)))
+        return rawtx
+
+    def get_rawtxs_bulk(self, txids, verify=True):
+        """Fetches up to BULK_TX_LIMIT raw transactions at once (in a single request where the backend
+        supports it). Returns a list of rawtx (bytes) in the same order as txids"""
+        with self.metrics.stage('fetch') as stage:
+            rawtxs = self.backend.get_rawtxs(txids)
+            stage.add_bytes(sum(len(rawtx) for rawtx in rawtxs))
+        if verify:
+            for txid, rawtx in zip(txids, rawtxs):
+                if txid_from_rawtx(rawtx) != txid:
+                    raise ValueError('rawtx returned for {} has txid {}'.format(txid, txid_from_rawtx(rawtx)))
+        return rawtxs
+
+    def rawtx_from_txid(self, txid):
+        rawtx = self.cache.get(txid)
+        if rawtx is None:
+            rawtx = self.get_rawtx(txid)
+            self.cache.put(txid, rawtx)
+        return rawtx
+
+    def rawtxs_from_txids(self, txids):
+        """Bulk version of rawtx_from_txid - returns {txid: rawtx}.
+        Uncached txids are fetched BULK_TX_LIMIT at a time with up to max_workers requests in flight"""
+        result = {}
+        missing = []
+        for txid in txids:
+            rawtx = self.cache.get(txid)
+            if rawtx is not None:
+                result[txid] = rawtx
+            elif txid not in result:
+                missing.append(txid)
+                result[txid] = None
+        batches = [missing[i:i + BULK_TX_LIMIT] for i in range(0, len(missing), BULK_TX_LIMIT)]
+        for batch, rawtxs in zip(batches, self.imap_txids(self.get_rawtxs_bulk, batches)):
+            for txid, rawtx in zip(batch, rawtxs):
+                self.cache.put(txid, rawtx)
+                result[txid] = rawtx
+        return result
+
+    @staticmethod
+    def script_views_from_rawtx(rawtx):
+        """returns the output scripts of rawtx as memoryview slices (no copying)"""
+        _, outputs = deserialize_rawtx(memoryview(rawtx))
+        return [output.script for output in outputs]
+
+    def script_views_from_txid(self, txid):
+        rawtx = self.rawtx_from_txid(txid)
+        with self.metrics.stage('parse_tx', len(rawtx)):
+            return self.script_views_from_rawtx(rawtx)
+
+    def script_views_from_txids(self, txids):
+        """returns {txid: list of output scripts as memoryviews}"""
+        rawtxs = self.rawtxs_from_txids(txids)
+        with self.metrics.stage('parse_tx', sum(len(rawtx) for rawtx in rawtxs.values())):
+            return {txid: self.script_views_from_rawtx(rawtx) for txid, rawtx in rawtxs.items()}
+
     def scripts_from_txid(self, txid):
-        lst = []
-        tx = self.get_transaction(txid)
-        for output in tx.outputs:
-            lst.append(output.scriptpubkey)
-        return lst
+        """returns the output scripts of txid as hex"""
+        return [script.hex() for script in self.script_views_from_txid(txid)]
+
+    def scripts_from_txids(self, txids):
+        """Bulk version of scripts_from_txid - returns {txid: list of hex scripts}"""
+        return {txid: [script.hex() for script in scripts]
+                for txid, scripts in self.script_views_from_txids(txids).items()}
+
+    def imap_txids(self, func, txids):
+        """Yields func(txid) for each txid - in the same order as txids.
+        Up to max_workers calls run concurrently in a thread pool and at most max_workers
+        results are held in memory at once (so this is safe to use for very large BCAT files)"""
+        if self.max_workers <= 1 or len(txids) <= 1:
+            for txid in txids:
+                yield func(txid)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            for txid in txids:
+                pending.append(executor.submit(func, txid))
+                if len(pending) >= self.max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
 
     @staticmethod
     def binary_to_bsv_string(binary):
-        string = binary.decode('utf-8')
+        string = str(binary, 'utf-8')
         if string in ('\0','\t','\n','\x0B','\r',' ',''):
             string = None
         return string
 
     @staticmethod
-    def pushdata_from_script(script):
-        script = Download.hex_to_binary(script)
+    def pushdata_views_from_script(script):
+        """Same as pushdata_from_script but without copying: accepts a hex string, bytes or memoryview
+        and returns a list of memoryview slices into the (decoded) script"""
+        if isinstance(script, str):
+            script = Download.hex_to_binary(script)
+        script = memoryview(script)
+        if len(script) > 1 and script[0] == 0x00 and script[1] == 0x6a:
+            data = Download._op_return_pushdata_views(script)
+            if data is not None:
+                return data
         offset = 0
         data = []
         while offset < len(script):
             opcode = script[offset]
             offset += 1
             if opcode == 0x00: # OP_0, OP_FALSE
-                data.append(bytes(0))
+                data.append(script[offset:offset])
             elif opcode <= 0x4b: # short data
                 data.append(script[offset : offset + opcode])
                 offset += opcode
@@ -57,19 +237,17 @@ class Download(NetworkAPI):
                 data.append(script[offset + 1 : offset + 1 + length])
                 offset += 1 + length
             elif opcode == 0x4d: # OP_PUSHDATA2
-                length = script[offset] + script[offset + 1] * 0x100
+                length = int.from_bytes(script[offset : offset + 2], 'little')
                 data.append(script[offset + 2 : offset + 2 + length])
                 offset += 2 + length
             elif opcode == 0x4e: # OP_PUSHDATA4
-                length = script[offset] + script[offset + 1] * 0x100 + script[offset + 2] * 0x10000 + script[offset + 3] * 0x1000000
+                length = int.from_bytes(script[offset : offset + 4], 'little')
                 data.append(script[offset + 4 : offset + 4 + length])
                 offset += 4 + length
             elif opcode == 0x4f: # OP_1NEGATE
-                data.append(bytes([0xff])) # -1 is 0xff in twos complement
-            elif opcode == 0x51: # OP_1, OP_TRUE
-                data.append(bytes([0x01]))
-            elif opcode > 0x50 and opcode <= 0x60: # OP_#
-                data.append(bytes([opcode - 0x50]))
+                data.append(memoryview(b'\xff')) # -1 is 0xff in twos complement
+            elif opcode > 0x50 and opcode <= 0x60: # OP_1, OP_TRUE, OP_#
+                data.append(memoryview(bytes([opcode - 0x50])))
             elif opcode == 0x61: # OP_NOP
                 pass
             elif opcode == 0x6a: # OP_RETURN
@@ -83,18 +261,53 @@ class Download(NetworkAPI):
                 return []
         return data
 
+    @staticmethod
+    def _op_return_pushdata_views(script):
+        """Fast path for the usual OP_FALSE OP_RETURN <push> <push> ... layout (B, BCAT, BCAT part).
+        Returns None if any other opcode is found so the caller can fall back to the full parser"""
+        data = [script[1:1]]
+        offset = 2
+        end = len(script)
+        while offset < end:
+            opcode = script[offset]
+            if opcode <= 0x4b:
+                length = opcode
+                offset += 1
+            elif opcode == 0x4c:
+                length = script[offset + 1]
+                offset += 2
+            elif opcode == 0x4d:
+                length = int.from_bytes(script[offset + 1 : offset + 3], 'little')
+                offset += 3
+            elif opcode == 0x4e:
+                length = int.from_bytes(script[offset + 1 : offset + 5], 'little')
+                offset += 5
+            else:
+                return None
+            data.append(script[offset : offset + length])
+            offset += length
+        return data
+
+    @staticmethod
+    def pushdata_from_script(script):
+        """returns the list of pushdata (bytes) in a hex script - or [] if the script is not data-only"""
+        return [bytes(data) for data in Download.pushdata_views_from_script(script)]
+
     # B
 
     def b_detect_from_pushdata(self, data):
-        return len(data) >= 3 and (data[0].decode('utf-8') == B or data[1].decode('utf-8') == B)
+        return len(data) >= 3 and (data[0] == B_BYTES or data[1] == B_BYTES)
 
-    def b_detect_from_txid(self, txid):
-        for script in self.scripts_from_txid(txid):
-            data = self.pushdata_from_script(script)
+    def b_detect_from_scripts(self, scripts):
+        for script in scripts:
+            data = self.pushdata_views_from_script(script)
             if self.b_detect_from_pushdata(data):
                 return True
         return False
 
+    def b_detect_from_txid(self, txid):
+        return self.b_detect_from_scripts(self.script_views_from_txid(txid))
+
     def b_fields_from_pushdata(self, data):
         fields = {}
         if not self.b_detect_from_pushdata(data):
@@ -102,14 +315,14 @@ class Download(NetworkAPI):
         offset = 0
         if len(data[0]) == 0:
             offset = 1
-        fields['data'] = data[offset + 1]
-        fields['mediatype'] = data[offset + 2].decode('utf-8')
+        fields['data'] = bytes(data[offset + 1])
+        fields['mediatype'] = str(data[offset + 2], 'utf-8')
         if len(data) > offset + 3:
             fields['encoding'] = self.binary_to_bsv_string(data[offset + 3])
         if len(data) > offset + 4:
             fields['name'] = self.binary_to_bsv_string(data[offset + 4])
         if len(data) > offset + 5:
-            fields['extra'] = data[offset + 5:]
+            fields['extra'] = [bytes(extra) for extra in data[offset + 5:]]
         return fields
 
     def b_binary_from_pushdata(self, data):
@@ -120,9 +333,16 @@ class Download(NetworkAPI):
             return None
 
     def b_fields_from_txid(self, txid):
+        return self.b_fields_from_scripts(self.script_views_from_txid(txid))
+
+    def b_fields_from_scripts(self, scripts):
+        with self.metrics.stage('parse_pushdata'):
+            return self._b_fields_from_scripts(scripts)
+
+    def _b_fields_from_scripts(self, scripts):
         fields = {}
-        for script in self.scripts_from_txid(txid):
-            data = self.pushdata_from_script(script)
+        for script in scripts:
+            data = self.pushdata_views_from_script(script)
             newfields = self.b_fields_from_pushdata(data)
             if len(fields):
                 if 'extra' not in fields:
@@ -146,14 +366,17 @@ class Download(NetworkAPI):
     # BCAT
     
     def bcat_part_detect_from_pushdata(self, data):
-        return len(data) >= 2 and (data[0].decode('utf-8') == BCATPART or data[1].decode('utf-8') == BCATPART)
+        return len(data) >= 2 and (data[0] == BCATPART_BYTES or data[1] == BCATPART_BYTES)
 
-    def bcat_part_detect_fromtxid(self, txid):
-        for script in self.scripts_from_txid(txid):
-            data = self.pushdata_from_script(script)
+    def bcat_part_detect_from_scripts(self, scripts):
+        for script in scripts:
+            data = self.pushdata_views_from_script(script)
             if self.bcat_part_detect_from_pushdata(data):
                 return True
         return False
+
+    def bcat_part_detect_fromtxid(self, txid):
+        return self.bcat_part_detect_from_scripts(self.script_views_from_txid(txid))
    
     def bcat_part_binary_from_pushdata(self, data):
         if not self.bcat_part_detect_from_pushdata(data):
@@ -168,24 +391,34 @@ class Download(NetworkAPI):
         return b''.join(data[offset + 1:])
 
     def bcat_part_binary_from_txid(self, txid):
-        binary = b''
-        for script in self.scripts_from_txid(txid):
-            data = self.pushdata_from_script(script)
+        return self.bcat_part_binary_from_scripts(self.script_views_from_txid(txid))
+
+    def bcat_part_binary_from_scripts(self, scripts):
+        with self.metrics.stage('parse_pushdata'):
+            return self._bcat_part_binary_from_scripts(scripts)
+
+    def _bcat_part_binary_from_scripts(self, scripts):
+        binary = []
+        for script in scripts:
+            data = self.pushdata_views_from_script(script)
             newbinary = self.bcat_part_binary_from_pushdata(data)
             if newbinary is not None:
-                binary += newbinary
-        return binary
+                binary.append(newbinary)
+        return b''.join(binary)
 
     def bcat_linker_detect_from_pushdata(self, data):
-        return len(data) >= 8 and (data[0].decode('utf-8') == BCAT or data[1].decode('utf-8') == BCAT)
+        return len(data) >= 8 and (data[0] == BCAT_BYTES or data[1] == BCAT_BYTES)
 
-    def bcat_linker_detect_from_txid(self, txid):
-        for script in self.scripts_from_txid(txid):
-            data = self.pushdata_from_script(script)
+    def bcat_linker_detect_from_scripts(self, scripts):
+        for script in scripts:
+            data = self.pushdata_views_from_script(script)
             if self.bcat_linker_detect_from_pushdata(data):
                 return True
         return False
 
+    def bcat_linker_detect_from_txid(self, txid):
+        return self.bcat_linker_detect_from_scripts(self.script_views_from_txid(txid))
+
     def bcat_linker_fields_from_pushdata(self, data):
         fields = {}
         if not self.bcat_linker_detect_from_pushdata(data):
@@ -206,46 +439,209 @@ class Download(NetworkAPI):
         return fields
 
     def bcat_linker_fields_from_txid(self, txid):
+        return self.bcat_linker_fields_from_scripts(self.script_views_from_txid(txid))
+
+    def bcat_linker_fields_from_scripts(self, scripts):
+        with self.metrics.stage('parse_pushdata'):
+            return self._bcat_linker_fields_from_scripts(scripts)
+
+    def _bcat_linker_fields_from_scripts(self, scripts):
         fields = {}
-        for script in self.scripts_from_txid(txid):
-            data = self.pushdata_from_script(script)
+        for script in scripts:
+            data = self.pushdata_views_from_script(script)
             fields = self.bcat_linker_fields_from_pushdata(data)
             if fields:
                 break
         return fields
 
+    def protocols_from_txids(self, txids):
+        """Detects B, BCAT (linker) and BCATPART for many txids with bulk requests.
+        returns {txid: list of the bitcom prefixes detected}"""
+        prefixes = {'B': B, 'BCAT': BCAT, 'BCATPART': BCATPART}
+        protocols = {}
+        for txid, segments in self.decode_txids(txids).items():
+            protocols[txid] = []
+            for segment in segments:
+                prefix = prefixes.get(segment.protocol)
+                if prefix is not None and segment.fields is not None and prefix not in protocols[txid]:
+                    protocols[txid].append(prefix)
+        return protocols
+
+    # ALL PROTOCOLS
+
+    def decode_scripts(self, scripts):
+        """Parses each output script once and decodes every Bitcom protocol in it - including several
+        in one output separated by '|' (e.g. B | MAP | AIP). See polyglot.decoder.
+        returns a list of polyglot.decoder.Segment (protocol, txindex, fields)"""
+        segments = []
+        with self.metrics.stage('parse_pushdata'):
+            for txindex, script in enumerate(scripts):
+                data = self.pushdata_views_from_script(script)
+                if data:
+                    segments.extend(decode_pushdata(data, txindex))
+        return segments
+
+    def decode_txid(self, txid):
+        return self.decode_scripts(self.script_views_from_txid(txid))
+
+    def decode_txids(self, txids):
+        """Bulk version of decode_txid (one fetch per BULK_TX_LIMIT txids) - returns {txid: list of Segment}"""
+        return {txid: self.decode_scripts(scripts) for txid, scripts in self.script_views_from_txids(txids).items()}
+
+    def bcat_part_binaries_from_txids(self, txids):
+        scripts = self.script_views_from_txids(txids)
+        return [self.bcat_part_binary_from_scripts(scripts[txid]) for txid in txids]
+
+    def bcat_chunks_from_txids(self, txids):
+        """Yields the binary of each BCAT part in order - fetching ahead concurrently in batches of
+        BULK_TX_LIMIT but holding no more than max_workers batches in memory"""
+        batches = [txids[i:i + BULK_TX_LIMIT] for i in range(0, len(txids), BULK_TX_LIMIT)]
+        for binaries in self.imap_txids(self.bcat_part_binaries_from_txids, batches):
+            yield from binaries
+
+    @staticmethod
+    def gunzip_chunks(chunks):
+        """Incrementally decompresses gzip data that may be split across chunks at any point.
+        Consecutive gzip members (e.g. one per BCAT part) are decompressed one after the other.
+        Yields decompressed pieces of at most GUNZIP_CHUNK_SIZE bytes"""
+        stream = GunzipStream()
+        for chunk in chunks:
+            yield from stream.decompress(chunk)
+        stream.close()
+
+    def bcat_chunks_from_fields(self, fields, gunzip=True):
+        """Returns a generator over the contents of a BCAT file (given its linker fields) in order.
+        Memory use is bounded by a few parts regardless of the size of the file."""
+        chunks = self.bcat_chunks_from_txids(fields['parts'])
+        if gunzip and fields['flag'] in ('gzip', 'nested-gzip'):
+            # change 'flag' to reflect that we mutated the data
+            fields['flag'] = fields['flag'].replace('zip','unzipped')
+            chunks = self.gunzip_chunks(chunks)
+        return chunks
+
     def bcat_binary_from_txids(self, txids):
-        data = bytes()
-        for txid in txids:
-            data += self.bcat_part_binary_from_txid(txid)
-        return data
+        return b''.join(self.bcat_chunks_from_txids(txids))
 
     def bcat_fields_from_txid(self, txid, gunzip = True):
         fields = self.bcat_linker_fields_from_txid(txid)
         if not fields:
             return fields
-        fields['data'] = self.bcat_binary_from_txids(fields['parts'])
-        if gunzip and fields['flag'] in ('gzip', 'nested-gzip'):
-            # change 'flag' to reflect that we mutated the data
-            fields['flag'] = fields['flag'].replace('zip','unzipped')
-            # unzip
-            fields['data'] = gzip.decompress(fields['data'])
+        fields['data'] = b''.join(self.bcat_chunks_from_fields(fields, gunzip=gunzip))
         return fields
 
-    def download_bcat(self, txid, file, gunzip = True):
+    def download_bcat(self, txid, file, gunzip = True, resume=False):
+        """Streams a BCAT file to 'file' - either a path or a writable binary file-like object
+        (e.g. sys.stdout.buffer) - without ever holding the whole file in memory
+
+        With resume=True (file must be a path) progress is kept in a DownloadJournal next to the file
+        (file + DOWNLOAD_JOURNAL_SUFFIX). Re-running after a failure checks the parts already in the file,
+        truncates it after the last good one and fetches only the rest. The journal is kept afterwards
+        for verify_bcat. Parts are written as stored, so gzip files cannot be gunzipped in resume mode."""
         fields = self.bcat_linker_fields_from_txid(txid)
         if not fields:
             raise ValueError('bcat tx not found')
-        if gunzip and fields['flag'] in ('gzip', 'nested-gzip'):
-            # change 'flag' to reflect that we mutated the data
-            fields['flag'] = fields['flag'].replace('zip','unzipped')
-        else:
-            gunzip = False
+        if resume:
+            if hasattr(file, 'write'):
+                raise ValueError('resume needs a path to download to')
+            if gunzip and fields['flag'] in ('gzip', 'nested-gzip'):
+                raise ValueError('gzip BCAT files can only be resumed with gunzip=False')
+            self.bcat_parts_download_resumable(txid, fields['parts'], file)
+            return fields
+        chunks = self.bcat_chunks_from_fields(fields, gunzip=gunzip)
+        if hasattr(file, 'write'):
+            self.write_chunks(chunks, file)
+            return fields
         with open(file, 'wb') as f:
-            for txid in fields['parts']:
-                data = self.bcat_part_binary_from_txid(txid)
-                if gunzip:
-                    data = gzip.decompress(data)
-                f.write(data)
+            self.write_chunks(chunks, f)
         return fields
 
+    def write_chunks(self, chunks, f):
+        for data in chunks:
+            with self.metrics.stage('write', len(data)):
+                f.write(data)
+
+    @staticmethod
+    def bcat_parts_verified(journal, file):
+        """returns the indexes of the parts recorded in journal that are missing from file or whose
+        sha256 does not match"""
+        num_parts = len(journal.header['parts'])
+        if not os.path.exists(file):
+            return list(range(num_parts))
+        bad = []
+        with open(file, 'rb') as f:
+            for index in range(num_parts):
+                record = journal.parts.get(index)
+                if record is None:
+                    bad.append(index)
+                    continue
+                f.seek(record['offset'])
+                data = f.read(record['length'])
+                if len(data) != record['length'] or hashlib.sha256(data).hexdigest() != record['sha256']:
+                    bad.append(index)
+        return bad
+
+    def bcat_parts_download_resumable(self, txid, parts, file):
+        """Writes the BCAT parts to file, continuing after the last part already verified in its journal"""
+        journal = DownloadJournal(file + DOWNLOAD_JOURNAL_SUFFIX)
+        if journal.matches(txid, parts):
+            bad = self.bcat_parts_verified(journal, file)
+            start = bad[0] if bad else len(parts)
+        else:
+            journal.start(txid, parts)
+            start = 0
+        offset = 0
+        if start:
+            record = journal.parts[start - 1]
+            offset = record['offset'] + record['length']
+        with open(file, 'r+b' if os.path.exists(file) else 'wb') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            for index, data in enumerate(self.bcat_chunks_from_txids(parts[start:]), start):
+                f.write(data)
+                # the part must reach the file before the journal says it is there
+                f.flush()
+                journal.add_part(index, offset, len(data), hashlib.sha256(data).hexdigest())
+                offset += len(data)
+
+    def verify_bcat(self, txid, file):
+        """Checks a file written by download_bcat(txid, file, resume=True) against the linker's part list
+        using the hashes in its journal - only the linker is fetched, not the parts.
+        returns the indexes of missing or corrupt parts (empty if the file is complete and intact)"""
+        fields = self.bcat_linker_fields_from_txid(txid)
+        if not fields:
+            raise ValueError('bcat tx not found')
+        journal = DownloadJournal(file + DOWNLOAD_JOURNAL_SUFFIX)
+        if not journal.matches(txid, fields['parts']):
+            raise ValueError('no download journal for bcat tx ' + txid + ' at ' + journal.path)
+        bad = self.bcat_parts_verified(journal, file)
+        if not bad and fields['parts']:
+            last = journal.parts[len(fields['parts']) - 1]
+            if os.path.getsize(file) != last['offset'] + last['length']:
+                bad.append(len(fields['parts']) - 1)  # trailing bytes after the last part
+        return bad
+
+    def download(self, txid, file, gunzip=True, resume=False):
+        """Downloads the B:// or BCAT:// file at txid (detected automatically) to 'file' - a path,
+        a directory (the file is named after the name in the tx, or the txid) or a writable binary
+        file-like object such as sys.stdout.buffer. BCAT parts are fetched concurrently and streamed.
+        resume applies to BCAT files written to a path (see download_bcat).
+
+        returns the fields of the tx (as b_fields_from_txid / bcat_linker_fields_from_txid)"""
+        scripts = self.script_views_from_txid(txid)
+        if self.bcat_linker_detect_from_scripts(scripts):
+            fields = self.bcat_linker_fields_from_txid(txid)
+        elif self.b_detect_from_scripts(scripts):
+            fields = self.b_fields_from_txid(txid)
+        else:
+            raise ValueError('no B or BCAT file found in tx ' + txid)
+        if not hasattr(file, 'write') and os.path.isdir(file):
+            name = os.path.basename((fields.get('name') or '').strip())
+            file = os.path.join(file, name if name not in ('', '.', '..') else txid)
+        if 'parts' in fields:
+            return self.download_bcat(txid, file, gunzip=gunzip, resume=resume)
+        if hasattr(file, 'write'):
+            file.write(fields['data'])
+        else:
+            with open(file, 'wb') as f:
+                f.write(fields['data'])
+        return fields
@@ -0,0 +1,136 @@
+import json
+import os
+import threading
+
+
+class UploadJournal:
+    """Append-only record of a BCAT upload (one json object per line) so that it can be resumed.
+
+    Every part's offset, length, txid and rawtx is written as soon as the part is signed, followed by
+    the linker. Broadcasts are then recorded one by one. After a crash or lost connection only the
+    transactions not yet recorded as sent need broadcasting again - nothing is re-signed or paid twice.
+
+    A journal is only resumable once the linker has been recorded (i.e. every tx was signed) -
+    nothing is broadcast before that point so an incomplete journal can simply be started over.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.header = None
+        self.parts = []
+        self.linker = None
+        self.sent = set()
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn final line from a crash mid-write
+                if record['type'] == 'upload':
+                    self.header = record
+                elif record['type'] == 'part':
+                    self.parts.append(record)
+                elif record['type'] == 'linker':
+                    self.linker = record
+                elif record['type'] == 'sent':
+                    self.sent.add(record['txid'])
+
+    def _append(self, record, sync=False):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def start(self, **header):
+        """Begins a new journal (discarding anything already at path)"""
+        self.header = dict(header, type='upload')
+        self.parts = []
+        self.linker = None
+        self.sent = set()
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(self.header) + '\n')
+
+    def add_part(self, offset, length, rawtx, txid):
+        record = {'type': 'part', 'index': len(self.parts), 'offset': offset, 'length': length,
+                  'txid': txid, 'rawtx': rawtx}
+        self.parts.append(record)
+        self._append(record)
+
+    def set_linker(self, rawtx, txid):
+        self.linker = {'type': 'linker', 'txid': txid, 'rawtx': rawtx}
+        # everything must be on disk before the first broadcast
+        self._append(self.linker, sync=True)
+
+    def mark_sent(self, txid):
+        self.sent.add(txid)
+        self._append({'type': 'sent', 'txid': txid})
+
+    def is_resumable(self):
+        return self.header is not None and self.linker is not None
+
+    def unsent_parts(self):
+        """returns [(txid, rawtx)] of the parts not yet broadcast"""
+        return [(part['txid'], part['rawtx']) for part in self.parts if part['txid'] not in self.sent]
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DownloadJournal:
+    """Sidecar record of a BCAT download (one json object per line) so that it can be resumed and verified.
+
+    The header holds the linker txid and its part txids. Each part's offset, length and sha256 in the
+    output file is appended once it has been written. A later record for the same index replaces an
+    earlier one. The journal is kept after the download completes so the file can be verified later
+    without fetching the parts again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.parts = {}  # index -> record
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn final line from a crash mid-write
+                if record['type'] == 'download':
+                    self.header = record
+                elif record['type'] == 'part':
+                    self.parts[record['index']] = record
+
+    def matches(self, txid, parts):
+        """True if this journal is for the BCAT file with linker txid and part txids parts"""
+        return self.header is not None and self.header['txid'] == txid and self.header['parts'] == list(parts)
+
+    def start(self, txid, parts):
+        """Begins a new journal (discarding anything already at path)"""
+        self.header = {'type': 'download', 'txid': txid, 'parts': list(parts)}
+        self.parts = {}
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(self.header) + '\n')
+
+    def add_part(self, index, offset, length, sha256):
+        record = {'type': 'part', 'index': index, 'offset': offset, 'length': length, 'sha256': sha256}
+        self.parts[index] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,141 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from collections import Counter
+
+
+class _NullStage:
+    """Shared do-nothing stage so that instrumentation costs one method call when disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add_bytes(self, nbytes):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class NullMetrics:
+    """The metrics used when none are given - records nothing"""
+    enabled = False
+
+    def stage(self, name, nbytes=0):
+        return _NULL_STAGE
+
+    def count(self, name, nbytes=0):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'nbytes', 'start', 'profiling')
+
+    def __init__(self, metrics, name, nbytes):
+        self.metrics = metrics
+        self.name = name
+        self.nbytes = nbytes
+
+    def add_bytes(self, nbytes):
+        """for stages that only know how many bytes they handled once they are done"""
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self.profiling = self.metrics._start_profile(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        if self.profiling:
+            self.metrics._stop_profile()
+        self.metrics._record(self.name, seconds, self.nbytes)
+        return False
+
+
+class Metrics:
+    """Per-stage timings, byte counters and call counters for an Upload / Download (pass metrics=Metrics()).
+
+    callback, if given, is called as callback(stage, seconds, nbytes) each time a stage completes (e.g. to
+    export to a monitoring system). Stages named in profile are also run under cProfile (one at a time -
+    calls made while another thread is being profiled are only timed); see print_profile.
+
+    Upload stages: get_unspents, media_type, gzip, create_pushdata, sign, send_rawtx, wait_confirmation.
+    Download stages: fetch (one call per request), parse_tx, parse_pushdata, write.
+    """
+    enabled = True
+
+    def __init__(self, callback=None, profile=()):
+        self.callback = callback
+        self.profile = frozenset(profile)
+        self.profiler = cProfile.Profile() if self.profile else None
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.bytes = Counter()
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+
+    def stage(self, name, nbytes=0):
+        """context manager timing one run of stage name (which handled nbytes)"""
+        return _Stage(self, name, nbytes)
+
+    def count(self, name, nbytes=0):
+        """records an (untimed) event such as a request"""
+        self._record(name, 0.0, nbytes)
+
+    def _record(self, name, seconds, nbytes):
+        with self._lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+            if nbytes:
+                self.bytes[name] += nbytes
+        if self.callback is not None:
+            self.callback(name, seconds, nbytes)
+
+    def _start_profile(self, name):
+        if name not in self.profile or not self._profile_lock.acquire(blocking=False):
+            return False
+        self.profiler.enable()
+        return True
+
+    def _stop_profile(self):
+        self.profiler.disable()
+        self._profile_lock.release()
+
+    def snapshot(self):
+        """returns {stage: {'calls', 'seconds', 'bytes'}}"""
+        with self._lock:
+            return {name: {'calls': self.calls[name], 'seconds': self.seconds[name], 'bytes': self.bytes[name]}
+                    for name in self.calls}
+
+    def reset(self):
+        with self._lock:
+            self.seconds.clear()
+            self.calls.clear()
+            self.bytes.clear()
+
+    def report(self):
+        """returns a table of the stages (slowest first)"""
+        lines = ['{:<20} {:>8} {:>10} {:>12}'.format('stage', 'calls', 'seconds', 'MB')]
+        for name, stats in sorted(self.snapshot().items(), key=lambda item: -item[1]['seconds']):
+            lines.append('{:<20} {:>8} {:>10.3f} {:>12.3f}'.format(name, stats['calls'], stats['seconds'],
+                                                                  stats['bytes'] / 1e6))
+        return '\n'.join(lines)
+
+    def print_profile(self, sort='cumulative', limit=30, file=None):
+        """prints the cProfile statistics gathered for the profiled stages"""
+        if self.profiler is None:
+            raise ValueError('no stages are profiled - pass profile=[stage names] to Metrics')
+        stream = io.StringIO() if file is None else file
+        pstats.Stats(self.profiler, stream=stream).sort_stats(sort).print_stats(limit)
+        if file is None:
+            print(stream.getvalue())
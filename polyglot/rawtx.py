@@ -0,0 +1,64 @@
+from collections import namedtuple
+
+from bitsv.crypto import double_sha256
+
+Input = namedtuple('Input', ('txid', 'txindex', 'script', 'sequence'))
+Output = namedtuple('Output', ('amount', 'script'))
+
+
+def read_varint(data, offset):
+    """returns (value, new offset)"""
+    prefix = data[offset]
+    if prefix < 0xfd:
+        return prefix, offset + 1
+    elif prefix == 0xfd:
+        return int.from_bytes(data[offset + 1:offset + 3], 'little'), offset + 3
+    elif prefix == 0xfe:
+        return int.from_bytes(data[offset + 1:offset + 5], 'little'), offset + 5
+    else:
+        return int.from_bytes(data[offset + 1:offset + 9], 'little'), offset + 9
+
+
+def txid_from_rawtx(rawtx):
+    """rawtx as bytes - returns txid as hex"""
+    return double_sha256(rawtx)[::-1].hex()
+
+
+def deserialize_rawtx(rawtx):
+    """Splits a rawtx (hex, bytes or memoryview) into its inputs and outputs.
+
+    returns (list of Input, list of Output) - txids are hex (display byte order), scripts are slices
+    of rawtx (so passing a memoryview gives zero-copy memoryview scripts)"""
+    if isinstance(rawtx, str):
+        rawtx = bytes.fromhex(rawtx)
+    inputs, outputs, end = parse_tx(rawtx)
+    if end != len(rawtx):
+        raise ValueError('rawtx has {} trailing bytes'.format(len(rawtx) - end))
+    return inputs, outputs
+
+
+def parse_tx(data, offset=0):
+    """Parses the tx starting at offset in data (e.g. a block) - returns (inputs, outputs, offset of the
+    end of the tx). See deserialize_rawtx"""
+    offset += 4  # version
+    num_inputs, offset = read_varint(data, offset)
+    inputs = []
+    for _ in range(num_inputs):
+        txid = data[offset:offset + 32][::-1].hex()
+        txindex = int.from_bytes(data[offset + 32:offset + 36], 'little')
+        script_len, offset = read_varint(data, offset + 36)
+        script = data[offset:offset + script_len]
+        offset += script_len
+        sequence = int.from_bytes(data[offset:offset + 4], 'little')
+        offset += 4
+        inputs.append(Input(txid, txindex, script, sequence))
+    num_outputs, offset = read_varint(data, offset)
+    outputs = []
+    for _ in range(num_outputs):
+        amount = int.from_bytes(data[offset:offset + 8], 'little')
+        script_len, offset = read_varint(data, offset + 8)
+        outputs.append(Output(amount, data[offset:offset + script_len]))
+        offset += script_len
+    if offset + 4 > len(data):
+        raise ValueError('tx is truncated')
+    return inputs, outputs, offset + 4  # locktime
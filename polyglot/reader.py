@@ -0,0 +1,179 @@
+import bisect
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .backends import BULK_TX_LIMIT
+from .download import Download
+
+# Parts fetched ahead (in one bulk request) when reads are sequential - 0 turns prefetching off
+DEFAULT_PREFETCH_PARTS = 4
+# Parts kept in memory (at least prefetch + 1)
+DEFAULT_CACHE_PARTS = 8
+
+
+class BcatReader(io.RawIOBase):
+    """Seekable, read-only file object over the content of a BCAT:// upload (the bytes as stored - a gzip
+    flag is not undone). Only the parts covering a read are fetched; sequential reads prefetch the next
+    parts in the background and recently used parts are kept in a small LRU.
+
+    Part sizes are not in the linker, so where a part starts is only known once every part before it has
+    been seen. Unless part_sizes is given (e.g. ScanIndex.get_part_sizes) the sizes are learnt in order as
+    reads need them: reading from the start costs nothing extra, but the first read far into the file (or
+    asking for size / seeking from the end) fetches the parts before it once, BULK_TX_LIMIT at a time.
+
+    Wrap in io.BufferedReader for small reads, e.g. io.BufferedReader(BcatReader(txid), 1024 * 1024)
+    """
+    def __init__(self, txid, downloader=None, prefetch=DEFAULT_PREFETCH_PARTS, cache_parts=DEFAULT_CACHE_PARTS,
+                 part_sizes=None):
+        super().__init__()
+        self._cache = OrderedDict()  # part index -> binary
+        self._pending = {}  # part index -> Future of {part index: binary}
+        self._executor = None
+        self.downloader = downloader if downloader is not None else Download()
+        self.fields = self.downloader.bcat_linker_fields_from_txid(txid)
+        if not self.fields:
+            raise ValueError('bcat tx not found')
+        self.txid = txid
+        self.parts = self.fields['parts']
+        self.prefetch = prefetch
+        self.cache_parts = max(cache_parts, prefetch + 1)
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._position = 0
+        self._sequential_end = 0
+        # start offsets of the parts whose size is known (always a prefix of the parts) and the end of the last
+        self._offsets = [0]
+        if part_sizes is not None:
+            if len(part_sizes) != len(self.parts):
+                raise ValueError('bcat {} has {} parts, not {}'.format(txid, len(self.parts), len(part_sizes)))
+            for part_size in part_sizes:
+                self._offsets.append(self._offsets[-1] + part_size)
+
+    @property
+    def size(self):
+        """size of the content in bytes (learning the size of every part if not yet known)"""
+        self._learn_sizes(float('inf'))
+        return self._offsets[-1]
+
+    def _all_sizes_known(self):
+        return len(self._offsets) == len(self.parts) + 1
+
+    def _learn_sizes(self, position):
+        """fetches parts in order until the part holding byte 'position' (or the last part) has a known size"""
+        while not self._all_sizes_known() and self._offsets[-1] <= position:
+            first = len(self._offsets) - 1
+            batch = range(first, min(first + BULK_TX_LIMIT, len(self.parts)))
+            binaries = self._get_parts(batch)
+            for index in batch:
+                self._offsets.append(self._offsets[-1] + len(binaries[index]))
+
+    def _fetch(self, indexes):
+        """returns {part index: binary} - one bulk fetch"""
+        indexes = sorted(indexes)
+        downloader = self.downloader
+        scripts = downloader.script_views_from_txids([self.parts[index] for index in indexes])
+        binaries = {}
+        for index in indexes:
+            part_scripts = scripts[self.parts[index]]
+            if not downloader.bcat_part_detect_from_scripts(part_scripts):
+                raise ValueError('tx {} is not a BCAT part'.format(self.parts[index]))
+            binaries[index] = downloader.bcat_part_binary_from_scripts(part_scripts)
+        return binaries
+
+    def _store(self, binaries):
+        for index, binary in binaries.items():
+            self._cache[index] = binary
+            self._cache.move_to_end(index)
+        while len(self._cache) > self.cache_parts:
+            self._cache.popitem(last=False)
+
+    def _get_parts(self, indexes):
+        """returns {part index: binary} from the cache, a prefetch or one bulk fetch of the rest - checked
+        against the part sizes already known"""
+        found = {}
+        missing = set()
+        for index in indexes:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                found[index] = self._cache[index]
+            elif index in self._pending:
+                binaries = self._pending.pop(index).result()
+                found[index] = binaries[index]
+            else:
+                missing.add(index)
+        if missing:
+            found.update(self._fetch(missing))
+        for index, binary in found.items():
+            if index + 1 < len(self._offsets) and len(binary) != self._offsets[index + 1] - self._offsets[index]:
+                raise ValueError('part {} of bcat {} is {} bytes, not {}'.format(
+                    index, self.txid, len(binary), self._offsets[index + 1] - self._offsets[index]))
+        self._store(found)
+        return found
+
+    def _start_prefetch(self, after):
+        indexes = [index for index in range(after + 1, min(after + 1 + self.prefetch, len(self.parts)))
+                   if index not in self._cache and index not in self._pending]
+        if indexes:
+            future = self._executor.submit(self._fetch, indexes)
+            for index in indexes:
+                self._pending[index] = future
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self.closed:
+            raise ValueError('seek on closed BcatReader')
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence ({})'.format(whence))
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self._position = offset
+        return offset
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('read from closed BcatReader')
+        start = self._position
+        self._learn_sizes(start + len(b) - 1)
+        end = min(start + len(b), self._offsets[-1])
+        if start >= end:
+            return 0
+        first = bisect.bisect_right(self._offsets, start) - 1
+        last = bisect.bisect_right(self._offsets, end - 1) - 1
+        binaries = self._get_parts(range(first, last + 1))
+        if self._executor is not None and start == self._sequential_end:
+            self._start_prefetch(last)
+        self._sequential_end = end
+        view = memoryview(b).cast('B')
+        written = 0
+        for index in range(first, last + 1):
+            offset = self._offsets[index]
+            piece = binaries[index][max(start - offset, 0):end - offset]
+            view[written:written + len(piece)] = piece
+            written += len(piece)
+        self._position = end
+        return written
+
+    def readall(self):
+        return self.read(max(self.size - self._position, 0))
+
+    def close(self):
+        if self._executor is not None:
+            for future in self._pending.values():
+                future.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._pending.clear()
+        self._cache.clear()
+        super().close()
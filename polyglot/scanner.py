@@ -0,0 +1,285 @@
+"""Offline indexing of B:// and BCAT:// transactions in raw block files (e.g. a node's blocks/blk*.dat).
+
+Files are memory-mapped and scanned in a process pool (one file per worker). Only the txs carrying a B,
+BCAT linker or BCAT part are kept: ScanIndex records their txid, protocol, media type, file name, size
+and where they are on disk (and each linker's list of parts) in SQLite. ScanIndexBackend then serves
+their rawtxs to Download straight from the block files:
+
+    index = ScanIndex('bitcom.db')
+    index.scan(glob.glob(os.path.expanduser('~/.bitcoin/blocks/blk*.dat')), max_workers=4)
+    Download(backend=ScanIndexBackend(index, fallback=WhatsonchainBackend())).download(txid, 'out/')
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from .backends import NetworkBackend
+from .decoder import decode_pushdata
+from .download import Download
+from .rawtx import parse_tx, read_varint
+
+BLOCK_HEADER_SIZE = 80
+
+# Message start bytes framing each block in blk*.dat files: the node's disk magic (for Bitcoin SV:
+# mainnet, testnet, regtest and the scaling testnet) and the network magic some tools write instead
+BLOCK_FILE_MAGICS = frozenset(bytes.fromhex(magic) for magic in (
+    'f9beb4d9', '0b110907', 'fabfb5da', 'fbcec4f9',
+    'e3e1f3e8', 'f4e5f3f4', 'dab5bffa'))
+
+# file_format values: 'blk' (magic and size framed blocks), 'block' (a single serialized block) and
+# 'txs' (raw txs back to back) - None detects which
+FILE_FORMATS = ('blk', 'block', 'txs')
+
+INDEXED_PROTOCOLS = ('B', 'BCAT', 'BCATPART')
+
+
+def detect_file_format(data):
+    if bytes(data[:4]) in BLOCK_FILE_MAGICS:
+        return 'blk'
+    try:
+        end = None
+        for _, end, _ in block_txs(data, 0):
+            pass
+        if end == len(data):
+            return 'block'
+    except (IndexError, ValueError):
+        pass
+    return 'txs'
+
+
+def block_txs(data, offset):
+    """Yields (start, end, outputs) for each tx of the serialized block at offset in data"""
+    num_txs, offset = read_varint(data, offset + BLOCK_HEADER_SIZE)
+    for _ in range(num_txs):
+        _, outputs, end = parse_tx(data, offset)
+        yield offset, end, outputs
+        offset = end
+
+
+def file_txs(data, file_format):
+    """Yields (start, end, outputs) for each tx in the mapped file"""
+    if file_format == 'blk':
+        offset = 0
+        # blk files are preallocated, so the last block is followed by zeros
+        while offset + 8 <= len(data) and bytes(data[offset:offset + 4]) in BLOCK_FILE_MAGICS:
+            size = int.from_bytes(data[offset + 4:offset + 8], 'little')
+            yield from block_txs(data, offset + 8)
+            offset += 8 + size
+    elif file_format == 'block':
+        yield from block_txs(data, 0)
+    else:
+        offset = 0
+        while offset < len(data):
+            _, outputs, end = parse_tx(data, offset)
+            yield offset, end, outputs
+            offset = end
+
+
+def classify_outputs(outputs):
+    """returns (protocol, fields) for the first B, BCAT or BCATPART segment in outputs - or None"""
+    for txindex, output in enumerate(outputs):
+        script = output.script
+        # cheap test before parsing: data carriers start OP_RETURN or OP_FALSE OP_RETURN
+        if not (len(script) > 1 and (script[0] == 0x6a or script[1] == 0x6a)):
+            continue
+        data = Download.pushdata_views_from_script(script)
+        if not data:
+            continue
+        for segment in decode_pushdata(data, txindex):
+            if segment.protocol in INDEXED_PROTOCOLS and segment.fields is not None:
+                return segment.protocol, segment.fields
+    return None
+
+
+def _scan_mapped(mapped, path, file_format):
+    data = memoryview(mapped)
+    if file_format is None:
+        file_format = detect_file_format(data)
+    rows = []
+    parts = []
+    for start, end, outputs in file_txs(data, file_format):
+        found = classify_outputs(outputs)
+        if found is None:
+            continue
+        protocol, fields = found
+        # only the txs kept are hashed
+        txid = hashlib.sha256(hashlib.sha256(data[start:end]).digest()).digest()[::-1].hex()
+        size = len(fields['data']) if 'data' in fields else None
+        rows.append((txid, protocol, fields.get('mediatype'), fields.get('encoding'), fields.get('name'),
+                     fields.get('flag'), size, path, start, end - start))
+        if protocol == 'BCAT':
+            parts.extend((txid, index, part) for index, part in enumerate(fields['parts']))
+    return rows, parts
+
+
+def scan_file(path, file_format=None):
+    """Scans one file (see FILE_FORMATS) - returns (tx rows, BCAT part rows) for ScanIndex.
+    Runs in the worker processes of ScanIndex.scan"""
+    if file_format is not None and file_format not in FILE_FORMATS:
+        raise ValueError('file_format must be one of {}'.format(', '.join(FILE_FORMATS)))
+    path = os.path.abspath(path)
+    if os.path.getsize(path) == 0:
+        return [], []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        try:
+            return _scan_mapped(mapped, path, file_format)
+        except (IndexError, ValueError):
+            # not raised from here: the traceback holds views into the map, which could then not be closed
+            pass
+    raise ValueError('{} is truncated or not in {} format'.format(path, file_format or 'a known'))
+
+
+class ScanIndex:
+    """Local SQLite index of the B://, BCAT:// linker and BCAT part txs found in block files.
+
+    A BCAT linker's size (the bytes on chain - before any gunzip) is filled in once all its parts have
+    been indexed. Files are only rescanned when their size or modification time changes.
+
+    Safe to share between threads
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS txs (txid TEXT PRIMARY KEY, protocol TEXT NOT NULL, '
+                             'media_type TEXT, encoding TEXT, file_name TEXT, flag TEXT, size INTEGER, '
+                             'path TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS txs_protocol ON txs (protocol, media_type)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS bcat_parts (txid TEXT NOT NULL, part_index INTEGER '
+                             'NOT NULL, part_txid TEXT NOT NULL, PRIMARY KEY (txid, part_index))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                             'mtime_ns INTEGER NOT NULL)')
+
+    def scan(self, paths, max_workers=None, file_format=None):
+        """Indexes the Bitcom txs in the files at paths, max_workers files at a time in separate processes
+        (default: one per cpu). returns the number of txs indexed"""
+        pending = []
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            with self._lock:
+                row = self._db.execute('SELECT size, mtime_ns FROM files WHERE path = ?', (path,)).fetchone()
+            if row != (stat.st_size, stat.st_mtime_ns):
+                pending.append((path, stat))
+        if not pending:
+            return 0
+
+        count = 0
+        paths = [path for path, _ in pending]
+        if max_workers == 1 or len(pending) == 1:
+            results = (scan_file(path, file_format) for path in paths)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+            results = executor.map(scan_file, paths, [file_format] * len(paths))
+        try:
+            for (path, stat), (rows, parts) in zip(pending, results):
+                with self._lock, self._db:
+                    self._db.executemany('INSERT OR REPLACE INTO txs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                    self._db.executemany('INSERT OR REPLACE INTO bcat_parts VALUES (?, ?, ?)', parts)
+                    self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                                     (path, stat.st_size, stat.st_mtime_ns))
+                count += len(rows)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self._update_bcat_sizes()
+        return count
+
+    def _update_bcat_sizes(self):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE txs SET size = (SELECT SUM(part.size) FROM bcat_parts JOIN txs AS part "
+                "ON part.txid = bcat_parts.part_txid WHERE bcat_parts.txid = txs.txid) "
+                "WHERE protocol = 'BCAT' AND size IS NULL AND NOT EXISTS (SELECT 1 FROM bcat_parts "
+                "LEFT JOIN txs AS part ON part.txid = bcat_parts.part_txid "
+                "WHERE bcat_parts.txid = txs.txid AND part.txid IS NULL)")
+
+    def get(self, txid):
+        """returns {'txid', 'protocol', 'mediatype', 'encoding', 'name', 'flag', 'size'} (and 'parts' for a
+        BCAT linker) - or None if txid is not indexed"""
+        with self._lock:
+            row = self._db.execute('SELECT txid, protocol, media_type, encoding, file_name, flag, size FROM txs '
+                                   'WHERE txid = ?', (txid,)).fetchone()
+            if row is None:
+                return None
+            fields = dict(zip(('txid', 'protocol', 'mediatype', 'encoding', 'name', 'flag', 'size'), row))
+            if fields['protocol'] == 'BCAT':
+                fields['parts'] = [part for part, in self._db.execute(
+                    'SELECT part_txid FROM bcat_parts WHERE txid = ? ORDER BY part_index', (txid,))]
+        return fields
+
+    def get_part_sizes(self, txid):
+        """returns the size of each part of the BCAT linker at txid (for BcatReader) - or None unless the
+        linker and all of its parts are indexed"""
+        with self._lock:
+            rows = self._db.execute('SELECT part.size FROM bcat_parts LEFT JOIN txs AS part '
+                                    'ON part.txid = bcat_parts.part_txid WHERE bcat_parts.txid = ? '
+                                    'ORDER BY bcat_parts.part_index', (txid,)).fetchall()
+        if not rows or any(size is None for size, in rows):
+            return None
+        return [size for size, in rows]
+
+    def find(self, protocol=None, media_type=None):
+        """returns the txids indexed with this protocol ('B', 'BCAT' or 'BCATPART') and / or media type"""
+        query = 'SELECT txid FROM txs'
+        conditions = [(column, value) for column, value in (('protocol', protocol), ('media_type', media_type))
+                      if value is not None]
+        if conditions:
+            query += ' WHERE ' + ' AND '.join('{} = ?'.format(column) for column, _ in conditions)
+        with self._lock:
+            return [txid for txid, in self._db.execute(query, [value for _, value in conditions])]
+
+    def get_rawtx(self, txid):
+        """returns the rawtx of an indexed tx (read from its block file) - or None"""
+        with self._lock:
+            row = self._db.execute('SELECT path, offset, length FROM txs WHERE txid = ?', (txid,)).fetchone()
+        if row is None:
+            return None
+        path, offset, length = row
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ScanIndexBackend(NetworkBackend):
+    """Serves rawtxs from a ScanIndex (pass backend=ScanIndexBackend(index) to Download). Txs that are not
+    indexed - and everything else - go to fallback (e.g. a WhatsonchainBackend) if one is given"""
+    def __init__(self, index, fallback=None):
+        self.index = index
+        self.fallback = fallback
+
+    def _fallback(self):
+        if self.fallback is None:
+            raise ValueError('not in the scan index and no fallback backend')
+        return self.fallback
+
+    def get_unspents(self, address):
+        return self._fallback().get_unspents(address)
+
+    def get_transactions(self, address):
+        return self._fallback().get_transactions(address)
+
+    def get_rawtx(self, txid):
+        rawtx = self.index.get_rawtx(txid)
+        if rawtx is None:
+            return self._fallback().get_rawtx(txid)
+        return rawtx
+
+    def get_rawtxs(self, txids):
+        rawtxs = {txid: self.index.get_rawtx(txid) for txid in txids}
+        missing = [txid for txid, rawtx in rawtxs.items() if rawtx is None]
+        if missing:
+            rawtxs.update(zip(missing, self._fallback().get_rawtxs(missing)))
+        return [rawtxs[txid] for txid in txids]
+
+    def send_rawtx(self, rawtx):
+        return self._fallback().send_rawtx(rawtx)
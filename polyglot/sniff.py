@@ -0,0 +1,81 @@
+import threading
+from collections import namedtuple
+from pathlib import Path
+
+# libmagic only needs the start of a file to tell its type and encoding
+SNIFF_SIZE = 1024 * 1024  # bytes
+
+FileMetadata = namedtuple('FileMetadata', ('media_type', 'encoding', 'file_name'))
+
+# Extension -> (media type, encoding) for common web content, so that most files need no libmagic at all.
+# An encoding of None (text formats) is detected from the content
+EXTENSION_MEDIA_TYPES = {
+    'jpg': ('image/jpeg', 'binary'), 'jpeg': ('image/jpeg', 'binary'), 'png': ('image/png', 'binary'),
+    'gif': ('image/gif', 'binary'), 'webp': ('image/webp', 'binary'), 'bmp': ('image/bmp', 'binary'),
+    'tif': ('image/tiff', 'binary'), 'tiff': ('image/tiff', 'binary'),
+    'ico': ('image/vnd.microsoft.icon', 'binary'),
+    'mp4': ('video/mp4', 'binary'), 'webm': ('video/webm', 'binary'), 'mp3': ('audio/mpeg', 'binary'),
+    'ogg': ('audio/ogg', 'binary'), 'flac': ('audio/flac', 'binary'), 'wav': ('audio/x-wav', 'binary'),
+    'pdf': ('application/pdf', 'binary'), 'zip': ('application/zip', 'binary'),
+    'gz': ('application/gzip', 'binary'), 'wasm': ('application/wasm', 'binary'),
+    'woff': ('font/woff', 'binary'), 'woff2': ('font/woff2', 'binary'),
+    'html': ('text/html', None), 'htm': ('text/html', None), 'css': ('text/css', None),
+    'js': ('application/javascript', None), 'json': ('application/json', None), 'svg': ('image/svg+xml', None),
+    'txt': ('text/plain', None), 'md': ('text/markdown', None), 'csv': ('text/csv', None), 'xml': ('text/xml', None),
+}
+
+
+def read_head(file, size=SNIFF_SIZE):
+    with open(file, 'rb') as f:
+        return f.read(size)
+
+
+def text_encoding(binary):
+    """'us-ascii' or 'utf-8' (as libmagic names them) - or None if binary is neither"""
+    for encoding, name in (('ascii', 'us-ascii'), ('utf-8', 'utf-8')):
+        try:
+            binary.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        return name
+    return None
+
+
+class MetadataSniffer:
+    """Media type, encoding and file name of a file in one call (see sniff).
+
+    Files with an extension in the extensions table (EXTENSION_MEDIA_TYPES by default - pass extensions={}
+    to always look at the content) are typed without libmagic. Otherwise one libmagic handle per thread is
+    loaded on first use and reused, and it is given the file's contents from memory - at most SNIFF_SIZE
+    bytes are read from disk, or none if the caller already has them.
+
+    Safe to share between threads
+    """
+    def __init__(self, extensions=None):
+        self.extensions = EXTENSION_MEDIA_TYPES if extensions is None else extensions
+        self._local = threading.local()
+
+    def _magic(self):
+        """returns this thread's (media type handle, encoding handle)"""
+        handles = getattr(self._local, 'handles', None)
+        if handles is None:
+            import magic
+            handles = self._local.handles = (magic.Magic(mime=True), magic.Magic(mime_encoding=True))
+        return handles
+
+    def sniff(self, file, binary=None):
+        """returns FileMetadata(media_type, encoding, file_name) for the file at path 'file' - binary, if
+        given, is its contents"""
+        path = Path(file)
+        file_name = path.name
+        known = self.extensions.get(path.suffix[1:].lower())
+        if known is not None and known[1] is not None:
+            return FileMetadata(known[0], known[1], file_name)
+        head = read_head(file) if binary is None else bytes(binary[:SNIFF_SIZE])
+        if known is not None:
+            encoding = text_encoding(head)
+            if encoding is None:
+                encoding = self._magic()[1].from_buffer(head)
+            return FileMetadata(known[0], encoding, file_name)
+        media_type_magic, encoding_magic = self._magic()
+        return FileMetadata(media_type_magic.from_buffer(head), encoding_magic.from_buffer(head), file_name)
@@ -1,29 +1,113 @@
+import gzip
+import hashlib
+import io
+import math
 import os
 import sys
 import time
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 import bitsv
+import requests
 from bitsv import op_return
 from bitsv import crypto
 from bitsv import utils
+from bitsv.transaction import DUST, create_p2pkh_transaction
+from .backends import WhatsonchainBackend
 from .bitcom import B, C, BCAT, BCATPART, D, AIP, MAP
+from .dedup import sha256_chunks, sha256_file
+from .journal import UploadJournal
+from .metrics import NULL_METRICS
+from .sniff import MetadataSniffer
+from .utxos import UtxoTracker, DEFAULT_MAX_AGE
 
-# Temp hack to allow space for funding inputs (10,000 bytes allocated)
+# Default size limit of the OP_RETURN output script of a transaction (configurable per Upload)
 MAX_DATA_CARRIER_SIZE = 100_000  # bytes
-SPACE_AVAILABLE_PER_TX_BCAT_PART = MAX_DATA_CARRIER_SIZE - \
-    len(BCATPART.encode('utf-8')) - 10000  # temporary hack (-) 10,000 bytes
+
+# Exact sizes of everything in a BCAT part tx except the data:
+# OP_FALSE OP_RETURN + (push + prefix) + OP_PUSHDATA4 header for the data
+BCAT_PART_SCRIPT_OVERHEAD = 2 + 1 + len(BCATPART.encode('utf-8')) + 5
+# version + input count + one compressed P2PKH input (worst case signature length) + output count
+# + OP_RETURN output amount + script length varint (worst case) + locktime
+P2PKH_INPUT_SIZE = 32 + 4 + 1 + 107 + 4
+BCAT_PART_TX_OVERHEAD = 4 + 1 + P2PKH_INPUT_SIZE + 1 + 8 + 5 + 4
+P2PKH_OUTPUT_SIZE = 8 + 1 + 25
+# Everything in a B:// tx except the data and its inputs: OP_FALSE OP_RETURN + (push + prefix) + OP_PUSHDATA4
+# header for the data + room for the media type, encoding and file name pushes (up to 255 bytes each),
+# the rest of the tx and a change output
+B_SCRIPT_OVERHEAD = 2 + 1 + len(B.encode('utf-8')) + 5 + 3 * (2 + 255)
+B_TX_OVERHEAD = 4 + 1 + 1 + 8 + 5 + 4 + P2PKH_OUTPUT_SIZE
+
+# Data per part for a 'Fresh' utxo of MAX_DATA_CARRIER_SIZE satoshis at 1 sat/byte (the defaults)
+SPACE_AVAILABLE_PER_TX_BCAT_PART = MAX_DATA_CARRIER_SIZE - BCAT_PART_TX_OVERHEAD - BCAT_PART_SCRIPT_OVERHEAD
+
+# Number of rawtxs broadcast concurrently (and chunks compressed concurrently)
+DEFAULT_MAX_WORKERS = 8
+
+# Media types that are already compressed - gzipping them again gains nothing
+COMPRESSED_MEDIA_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'application/zip',
+                          'application/gzip', 'application/x-gzip', 'application/x-bzip2', 'application/x-xz',
+                          'application/x-7z-compressed', 'application/x-rar', 'application/pdf')
+COMPRESSED_MEDIA_TYPE_PREFIXES = ('video/', 'audio/')
+# Files are gzipped in independent chunks (concatenated gzip members) of this size so that large files
+# can be compressed in parallel
+GZIP_CHUNK_SIZE = 1024 * 1024  # bytes
+
+# Jobs handed to each signing process at a time by build_rawtxs
+SIGNING_CHUNKSIZE = 16
+
+# The Upload each signing process builds its txs with and the settings it was built from (see build_rawtxs)
+_process_uploader = None
+_process_settings = None
+
+
+def gzip_member(binary):
+    """gzip.compress with the header's mtime fixed at 0 - so the same data always compresses to the same
+    bytes (and BCAT parts of it can be deduplicated)"""
+    stream = io.BytesIO()
+    with gzip.GzipFile(fileobj=stream, mode='wb', mtime=0) as f:
+        f.write(binary)
+    return stream.getvalue()
+
+
+def _build_rawtx_in_process(settings, method, args):
+    """settings is (wif, network, fee, max_data_carrier_size) - sent with every job as ProcessPoolExecutor
+    has no initializer before Python 3.7, and the Upload built from them is kept for the next job"""
+    global _process_uploader, _process_settings
+    if settings != _process_settings:
+        wif, network, fee, max_data_carrier_size = settings
+        _process_uploader = Upload(wif=wif, network=network, fee=fee, max_data_carrier_size=max_data_carrier_size)
+        _process_settings = settings
+    rawtx = getattr(_process_uploader, method)(*args)
+    return rawtx, _process_uploader.calculate_txid(rawtx)
 
 
 class Upload(bitsv.PrivateKey):
     """
     A simple interface to a multitude of bitcoin protocols
+
+    Unspents are served from a local UtxoTracker which is updated with every tx broadcast via
+    send_rawtx and only re-queries the network every utxo_max_age seconds (or on refresh_unspents)
+
+    Pass dedup_index=DedupIndex(path) to skip uploading files (and BCAT parts) that are already on chain.
+    Unspents are fetched and txs broadcast through backend (whatsonchain by default - see polyglot.backends).
+    Pass metrics=Metrics() to time each stage of an upload (see polyglot.metrics).
+    Media types and encodings are found by sniffer (a MetadataSniffer by default - see polyglot.sniff)
     """
-    def __init__(self, wif=None, network='main', fee=1, utxo_min_confirmations=1):
+    def __init__(self, wif=None, network='main', fee=1, utxo_min_confirmations=1, max_workers=DEFAULT_MAX_WORKERS,
+                 utxo_max_age=DEFAULT_MAX_AGE, max_data_carrier_size=MAX_DATA_CARRIER_SIZE, dedup_index=None,
+                 backend=None, metrics=None, sniffer=None):
         super().__init__(wif=wif, network=network)
-        self.woc = bitsv.network.services.WhatsonchainNormalised(api_key=None, network=network)
+        self.backend = backend if backend is not None else WhatsonchainBackend(network=network)
         self.fee = fee
         self.utxo_min_confirmations = utxo_min_confirmations
+        self.max_workers = max_workers
+        self.max_data_carrier_size = max_data_carrier_size
+        self.dedup_index = dedup_index
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.sniffer = sniffer if sniffer is not None else MetadataSniffer()
+        self.utxo_tracker = UtxoTracker(self.fetch_unspents, self.scriptcode,
+                                        max_age=utxo_max_age)
 
     # UTILITIES
     @staticmethod
@@ -53,15 +137,129 @@ class Upload(bitsv.PrivateKey):
         return ext
 
     def get_media_type_for_file_name(self, file):
-        import magic
-        return magic.from_file(file, mime=True)
+        with self.metrics.stage('media_type'):
+            return self.sniffer.sniff(file).media_type
 
     def get_encoding_for_file_name(self, file):
-        import magic
-        return magic.Magic(mime_encoding=True).from_file(file)
+        with self.metrics.stage('media_type'):
+            return self.sniffer.sniff(file).encoding
+
+    def file_metadata(self, file, binary=None, media_type=None, encoding=None, file_name=None):
+        """returns (media_type, encoding, file_name) - those not given are found from file (binary, if
+        given, being its contents) with one sniff"""
+        if media_type is None or encoding is None:
+            with self.metrics.stage('media_type'):
+                metadata = self.sniffer.sniff(file, binary)
+            media_type = metadata.media_type if media_type is None else media_type
+            encoding = metadata.encoding if encoding is None else encoding
+        if file_name is None:
+            file_name = self.get_filename(file)
+        return media_type, encoding, file_name
+
+    def fetch_unspents(self):
+        """Queries the backend for this key's unspents (bypassing the UtxoTracker)"""
+        with self.metrics.stage('get_unspents'):
+            return self.backend.get_unspents(self.address)
+
+    def get_unspents(self):
+        """Gets all unspent transaction outputs belonging to this key from the local UtxoTracker"""
+        self.unspents[:] = self.utxo_tracker.get()
+        self.balance = sum(unspent.amount for unspent in self.unspents)
+        return self.unspents
+
+    def refresh_unspents(self):
+        """Reconciles the local utxo set with the network now"""
+        self.utxo_tracker.refresh()
+        return self.get_unspents()
+
+    def get_transactions(self):
+        """Fetches the txids of this key's transaction history from the backend"""
+        self.transactions = self.backend.get_transactions(self.address)
+        return self.transactions
+
+    def send(self, outputs, fee=None, leftover=None, combine=True, message=None, unspents=None,
+             custom_pushdata=False):
+        """Same as bitsv.PrivateKey.send but broadcasts via send_rawtx (so the utxo set stays up to date)"""
+        self.get_unspents()
+        rawtx = self.create_transaction(outputs, fee=fee, leftover=leftover, combine=combine, message=message,
+                                        unspents=unspents, custom_pushdata=custom_pushdata)
+        self.send_rawtx(rawtx)
+        return self.calculate_txid(rawtx)
+
+    def send_op_return(self, list_of_pushdata, outputs=None, fee=None, unspents=None, leftover=None, combine=False):
+        """Same as bitsv.PrivateKey.send_op_return but broadcasts via send_rawtx (fee defaults to self.fee)"""
+        return self.send(outputs or [], fee=self.fee if fee is None else fee, leftover=leftover, combine=combine,
+                         message=op_return.create_pushdata(list_of_pushdata), unspents=unspents,
+                         custom_pushdata=True)
+
+    @staticmethod
+    def is_compressible(media_type):
+        return not (media_type in COMPRESSED_MEDIA_TYPES or media_type.startswith(COMPRESSED_MEDIA_TYPE_PREFIXES))
+
+    def gzip_binary(self, binary):
+        """gzips binary as one gzip member per GZIP_CHUNK_SIZE chunk (a valid gzip file which any gunzip -
+        including polyglot.Download - reads back as one), compressing up to max_workers chunks at once"""
+        chunks = [binary[i:i + GZIP_CHUNK_SIZE] for i in range(0, len(binary), GZIP_CHUNK_SIZE)] or [b'']
+        with self.metrics.stage('gzip', len(binary)):
+            if self.max_workers <= 1 or len(chunks) == 1:
+                return b''.join(gzip_member(chunk) for chunk in chunks)
+            # zlib releases the GIL while compressing so threads do run in parallel here
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return b''.join(executor.map(gzip_member, chunks))
 
     def send_rawtx(self, rawtx):
-        return self.woc.send_transaction(rawtx)
+        with self.metrics.stage('send_rawtx', len(rawtx) // 2):
+            result = self.backend.send_rawtx(rawtx)
+        self.utxo_tracker.record_rawtx(rawtx, self.calculate_txid(rawtx))
+        return result
+
+    def send_rawtxs(self, rawtxs, journal=None):
+        """Broadcasts independent rawtxs concurrently (up to max_workers at a time).
+        Returns the list of txids (calculated locally) in the same order as rawtxs
+
+        If an UploadJournal is given, txs it already records as sent are skipped and each successful
+        broadcast is recorded in it"""
+        send = self.send_rawtx if journal is None else lambda rawtx: self.send_rawtx_journaled(rawtx, journal)
+        if self.max_workers <= 1:
+            for rawtx in rawtxs:
+                send(rawtx)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(send, rawtxs))
+        return [self.calculate_txid(rawtx) for rawtx in rawtxs]
+
+    def send_rawtx_journaled(self, rawtx, journal):
+        """Broadcasts rawtx unless journal says it was already sent - a tx the network already knows
+        about (sent just before a crash) counts as sent"""
+        txid = self.calculate_txid(rawtx)
+        if txid in journal.sent:
+            return txid
+        try:
+            self.send_rawtx(rawtx)
+        except requests.HTTPError as e:
+            if e.response is None or 'already' not in e.response.text.lower():
+                raise
+        journal.mark_sent(txid)
+        return txid
+
+    def build_rawtxs(self, method, jobs, max_processes=None):
+        """Builds and signs many txs across a pool of processes (signing is CPU bound and would otherwise
+        use one core). method names an Upload method returning a rawtx and each job is its arguments,
+        with the utxo(s) to spend already assigned - e.g.
+        build_rawtxs('bcat_part_create_from_binary', [(data, utxo), ...]) or
+        build_rawtxs('b_create_rawtx_from_binary', [(binary, media_type, encoding, file_name, [utxo]), ...])
+
+        Nothing is broadcast. max_processes defaults to the number of cores.
+        returns (list of rawtx, list of txid) in the order of jobs"""
+        jobs = [tuple(bytes(arg) if isinstance(arg, memoryview) else arg for arg in job) for job in jobs]
+        if max_processes == 1 or len(jobs) <= 1:
+            rawtxs = [getattr(self, method)(*job) for job in jobs]
+            return rawtxs, [self.calculate_txid(rawtx) for rawtx in rawtxs]
+        settings = (self.to_wif(), self.network, self.fee, self.max_data_carrier_size)
+        with ProcessPoolExecutor(max_workers=max_processes) as executor:
+            results = list(executor.map(_build_rawtx_in_process, [settings] * len(jobs), [method] * len(jobs),
+                                        jobs, chunksize=SIGNING_CHUNKSIZE))
+        return [rawtx for rawtx, _ in results], [txid for _, txid in results]
 
     @staticmethod
     def calculate_txid(rawtx):
@@ -75,11 +273,14 @@ class Upload(bitsv.PrivateKey):
             ids.append(i['data']['txid'])
         return ids
 
-    def filter_utxos_for_bcat(self):
-        """filters out all utxos with 0 conf or too low amount for use in a BCAT part transaction"""
+    def filter_utxos_for_bcat(self, min_confirmations=None):
+        """filters out all utxos with too few confirmations (default: utxo_min_confirmations)
+        or too low amount for use in a BCAT part transaction"""
+        if min_confirmations is None:
+            min_confirmations = self.utxo_min_confirmations
         filtered_utxos = []
         for utxo in self.get_unspents():
-            if utxo.confirmations >= self.utxo_min_confirmations and utxo.amount >= self.fee * MAX_DATA_CARRIER_SIZE:
+            if utxo.confirmations >= min_confirmations and utxo.amount >= self.fresh_utxo_amount():
                 filtered_utxos.append(utxo)
         return filtered_utxos
 
@@ -101,20 +302,24 @@ class Upload(bitsv.PrivateKey):
         lst = []
         utxos = self.get_unspents()
         for utxo in utxos:
-            if utxo.amount != MAX_DATA_CARRIER_SIZE:
+            if utxo.amount != self.fresh_utxo_amount():
                 lst.append(utxo)
         return lst
 
+    def fresh_utxo_amount(self):
+        """amount (satoshis) of a 'Fresh' utxo - enough to fund one full BCAT part tx"""
+        return int(math.ceil(self.fee * self.max_data_carrier_size))
+
     def get_split_outputs(self, utxos):
-        """(crudely) splits utxos into 0.001 amounts with some remainder for fees"""
+        """(crudely) splits utxos into 'Fresh' utxo amounts with some remainder for fees"""
         sum = 0
         for utxo in utxos:
             sum += utxo.amount
-        num_splits = int(sum // (self.fee * MAX_DATA_CARRIER_SIZE)) - 1
+        num_splits = int(sum // self.fresh_utxo_amount()) - 1
         my_addr = self.address
         outputs = []
         for i in range(num_splits):
-            outputs.append((my_addr, self.fee * 0.001, 'bsv'))
+            outputs.append((my_addr, self.fresh_utxo_amount(), 'satoshi'))
         return outputs
 
     def combine_and_split_utxos(self, utxos):
@@ -129,49 +334,82 @@ class Upload(bitsv.PrivateKey):
         lst = self.get_nonbcatpart_utxos()
         return self.combine_and_split_utxos(lst)
 
+    def op_return_create_rawtx(self, pushdata, utxos):
+        """Builds and signs a tx with one OP_FALSE OP_RETURN <pushdata> output, spending the smallest of utxos
+        that pay for it (as bitsv would). Change is only added if it is above dust. Built directly (not via
+        create_transaction, which stops at 100kb) so the data carrier limit is max_data_carrier_size"""
+        script_size = len(pushdata) + 2
+        if script_size > self.max_data_carrier_size:
+            raise ValueError('OP_RETURN script of {} bytes exceeds max_data_carrier_size ({})'.format(
+                script_size, self.max_data_carrier_size))
+        if not utxos:
+            raise ValueError('Transactions must have at least one unspent.')
+        spent = []
+        amount = 0
+        for utxo in sorted(utxos, key=lambda utxo: utxo.amount):
+            spent.append(utxo)
+            amount += utxo.amount
+            size = (4 + len(utils.int_to_varint(len(spent))) + len(spent) * P2PKH_INPUT_SIZE + 1 +
+                    8 + len(utils.int_to_varint(script_size)) + script_size + 4)
+            if amount >= int(math.ceil(size * self.fee)):
+                break
+        outputs = [(pushdata, 0)]
+        change = amount - int(math.ceil((size + P2PKH_OUTPUT_SIZE) * self.fee))
+        if change > DUST:
+            outputs.append((self.address, change))
+        elif amount < int(math.ceil(size * self.fee)):
+            raise bitsv.exceptions.InsufficientFunds('Balance {} is less than {} (including fee).'.format(
+                amount, int(math.ceil(size * self.fee))))
+        with self.metrics.stage('sign'):
+            return create_p2pkh_transaction(self, spent, outputs, custom_pushdata=True)
+
     # B
 
-    def b_create_rawtx_from_binary(self, binary, media_type, encoding=' ', file_name=' '):
-        """Creates rawtx for sending data (<100kb) to the blockchain via the B:// protocol
+    def b_create_rawtx_from_binary(self, binary, media_type, encoding=' ', file_name=' ', utxos=None):
+        """Creates rawtx for sending data (up to max_data_carrier_size) to the blockchain via the B:// protocol
         see: https://github.com/unwriter/B or https://b.bitdb.network/ for details"""
-        hex_data = binary.hex()
-        lst_of_pushdata = [(B, "utf-8"),  # B:// protocol prefix
-                           (hex_data, 'hex'),
-                           (media_type, "utf-8"),
-                           (encoding, "utf-8"),  # Optional if no filename
-                           (file_name, "utf-8")]  # Optional
-        lst_of_pushdata = op_return.create_pushdata(lst_of_pushdata)
-        return self.create_transaction(outputs=[], message=lst_of_pushdata, combine=False,
-            custom_pushdata=True, unspents=self.filter_utxos_for_bcat(), fee=self.fee)
-
-    def b_create_rawtx_from_file(self, file, media_type=None, encoding=None, file_name=None):
+        if utxos is None:
+            utxos = self.filter_utxos_for_bcat()
+        # list of bytes (not (str, encoding) tuples, which bitsv caps at 100kb)
+        lst_of_pushdata = [B.encode('utf-8'),  # B:// protocol prefix
+                           bytes(binary),
+                           media_type.encode('utf-8'),
+                           encoding.encode('utf-8'),  # Optional if no filename
+                           file_name.encode('utf-8')]  # Optional
+        with self.metrics.stage('create_pushdata', len(binary)):
+            lst_of_pushdata = op_return.create_pushdata(lst_of_pushdata)
+        return self.op_return_create_rawtx(lst_of_pushdata, utxos)
+
+    def b_create_rawtx_from_file(self, file, media_type=None, encoding=None, file_name=None, utxos=None):
         # FIXME - add checks
-        if media_type is None:
-            media_type = self.get_media_type_for_file_name(file)
-        if encoding is None:
-            encoding = self.get_encoding_for_file_name(file)
-        if file_name is None:
-            file_name = self.get_filename(file)
         binary = self.file_to_binary(file)
-        return self.b_create_rawtx_from_binary(binary, media_type, encoding=encoding, file_name=file_name)
+        media_type, encoding, file_name = self.file_metadata(file, binary, media_type, encoding, file_name)
+        return self.b_create_rawtx_from_binary(binary, media_type, encoding=encoding, file_name=file_name,
+                                               utxos=utxos)
 
-    def b_send_from_file(self, file, media_type=None, encoding=None, file_name=None):
+    def b_send_from_file(self, file, media_type=None, encoding=None, file_name=None, utxos=None):
         """Convenience function to upload any file to the blockchain via the B:// protocol
         Extracts defaults for the media_type, encoding and filename from the file path
         Alternatively these parameters can be overridden as required
 
         A whitespace string can be used for encoding and filename if preferred"""
-        if media_type is None:
-            media_type = self.get_media_type_for_file_name(file)
-        if encoding is None:
-            encoding = self.get_encoding_for_file_name(file)
-        if file_name is None:
-            file_name = self.get_filename(file)
-        rawtx = self.b_create_rawtx_from_file(file, media_type, encoding=encoding, file_name=file_name)
-        return self.send_rawtx(rawtx)
+        binary = self.file_to_binary(file)
+        media_type, encoding, file_name = self.file_metadata(file, binary, media_type, encoding, file_name)
+        if self.dedup_index is not None:
+            sha256 = hashlib.sha256(binary).hexdigest()
+            txid = self.dedup_index.get_file(sha256, media_type)
+            if txid is not None:
+                return txid
+        rawtx = self.b_create_rawtx_from_binary(binary, media_type, encoding=encoding, file_name=file_name,
+                                                utxos=utxos)
+        txid = self.send_rawtx(rawtx)
+        if self.dedup_index is not None:
+            self.dedup_index.add_file(sha256, media_type, B, txid)
+        return txid
 
-    def b_send_from_binary(self, binary, media_type, encoding=' ', file_name=' '):
-        rawtx = self.b_create_rawtx_from_binary(binary, media_type, encoding=encoding, file_name=file_name)
+    def b_send_from_binary(self, binary, media_type, encoding=' ', file_name=' ', utxos=None):
+        rawtx = self.b_create_rawtx_from_binary(binary, media_type, encoding=encoding, file_name=file_name,
+                                                utxos=utxos)
         return self.send_rawtx(rawtx)
 
     # alias
@@ -180,41 +418,102 @@ class Upload(bitsv.PrivateKey):
     # BCAT
 
     @staticmethod
-    def get_number_bcat_parts(length_binary):
-        num_parts = (length_binary // SPACE_AVAILABLE_PER_TX_BCAT_PART) + 1
+    def get_number_bcat_parts(length_binary, space=SPACE_AVAILABLE_PER_TX_BCAT_PART):
+        num_parts = max(1, -(-length_binary // space))
         return num_parts
 
-    def bcat_parts_send_from_binary(self, binary, utxos=None):
-        """Takes in binary data for upload - returns list of rawtx"""
-
-        # Get full binary
-        stream = BytesIO(binary)
+    def bcat_part_space(self, amount=None):
+        """Number of bytes of data that fit in one BCAT part tx given the data carrier limit and
+        (if given) the amount of the utxo paying for it"""
+        space = self.max_data_carrier_size - BCAT_PART_SCRIPT_OVERHEAD
+        if amount is not None and self.fee:
+            affordable_size = int(amount // self.fee)
+            space = min(space, affordable_size - BCAT_PART_TX_OVERHEAD - BCAT_PART_SCRIPT_OVERHEAD)
+        return max(space, 0)
+
+    def plan_bcat_parts(self, length_binary, utxos):
+        """returns a list of (utxo, number of bytes of data) - one per part, each part sized to what its utxo can
+        pay for. Raises ValueError if utxos (leaving the last one for the linker) cannot cover the data"""
+        parts = []
+        remaining = length_binary
+        for utxo in utxos[:-1]:
+            size = min(remaining, self.bcat_part_space(utxo.amount))
+            if size == 0 and remaining:
+                continue
+            parts.append((utxo, size))
+            remaining -= size
+            if remaining == 0:
+                return parts
+        raise ValueError("insufficient 'Fresh' unspent transaction outputs (utxos) to complete the "
+                         "BCAT upload (" + str(len(utxos)) + " < " +
+                         str(len(parts) + self.get_number_bcat_parts(remaining, self.bcat_part_space()) + 1) +
+                         "). Please generate more 'Fresh' utxos and try again")
+
+    def bcat_part_create_from_binary(self, data, utxo):
+        """Builds and signs one BCAT part tx carrying data, spending utxo (see op_return_create_rawtx)"""
+        with self.metrics.stage('create_pushdata', len(data)):
+            pushdata = op_return.create_pushdata([BCATPART.encode('utf-8'), bytes(data)])
+        return self.op_return_create_rawtx(pushdata, [utxo])
+
+    def bcat_parts_create_from_binary(self, binary, utxos=None, journal=None, max_processes=1):
+        """Builds and signs every BCAT part transaction locally (nothing is broadcast) - returns list of rawtx
+
+        Each part spends its own 'Fresh' utxo so the parts do not depend on each other and can be
+        broadcast in any order (see send_rawtxs). Each part is filled with as much data as its utxo can pay
+        for, up to max_data_carrier_size. Parts are recorded in journal (an UploadJournal) once signed.
+        max_processes > 1 (or None for one per core) signs the parts in parallel (see build_rawtxs)"""
         if utxos is None:
             utxos = self.filter_utxos_for_bcat()
+        binary = memoryview(binary)
+        jobs = []
+        offsets = []
+        offset = 0
+        for utxo, size in self.plan_bcat_parts(len(binary), utxos):
+            jobs.append((binary[offset:offset + size], utxo))
+            offsets.append((offset, size))
+            offset += size
+        rawtxs, txids = self.build_rawtxs('bcat_part_create_from_binary', jobs, max_processes=max_processes)
+        if journal is not None:
+            for (offset, size), rawtx, txid in zip(offsets, rawtxs, txids):
+                journal.add_part(offset, size, rawtx, txid)
+        return rawtxs
+
+    def bcat_parts_create_deduplicated(self, binary, utxos=None, journal=None):
+        """Like bcat_parts_create_from_binary but reuses parts already in dedup_index.
+        The data is split into parts of a fixed size (what a 'Fresh' utxo pays for) so identical content
+        always gives identical parts. Only parts not found in the index are signed, each spending one utxo.
+
+        returns (txids of every part in order, [(sha256, length, rawtx)] of the new parts)"""
+        if utxos is None:
+            utxos = self.filter_utxos_for_bcat()
+        binary = memoryview(binary)
+        part_size = self.bcat_part_space(self.fresh_utxo_amount())
+        hashes = sha256_chunks(binary, part_size, self.max_workers)
+        existing = self.dedup_index.get_parts(hashes)
+        txids = []
+        new_parts = []
+        spendable = iter(utxos[:-1])
+        for index, sha256 in enumerate(hashes):
+            if sha256 in existing:
+                txids.append(existing[sha256])
+                continue
+            data = binary[index * part_size:(index + 1) * part_size]
+            utxo = next((utxo for utxo in spendable if self.bcat_part_space(utxo.amount) >= len(data)), None)
+            if utxo is None:
+                raise ValueError("insufficient 'Fresh' unspent transaction outputs (utxos) to complete the "
+                                 "BCAT upload. Please generate more 'Fresh' utxos and try again")
+            rawtx = self.bcat_part_create_from_binary(data, utxo)
+            txid = self.calculate_txid(rawtx)
+            if journal is not None:
+                journal.add_part(index * part_size, len(data), rawtx, txid)
+            txids.append(txid)
+            new_parts.append((sha256, len(data), rawtx))
+        return txids, new_parts
 
-        txs = []
-        number_bcat_parts = self.get_number_bcat_parts(len(binary))
-
-        if len(utxos) - 1 >= number_bcat_parts:  # Leaves one Fresh utxo leftover for linker.
-            pass
-        else:
-            raise ValueError("insufficient 'Fresh' unspent transaction outputs (utxos) to complete the "
-                             "BCAT upload (" + str(len(utxos)) + " < " + str(number_bcat_parts) + "). "
-                             "Please generate more 'Fresh' utxos and try again")
-
-        for i in range(number_bcat_parts):
-            data = stream.read(SPACE_AVAILABLE_PER_TX_BCAT_PART)
-            lst_of_pushdata = [(BCATPART, 'utf-8'),
-                               (data.hex(), 'hex')]
-
-            lst_of_pushdata = op_return.create_pushdata(lst_of_pushdata)
-            # bitsv sorts utxos by amount and then selects first the ones of *lowest* amount
-            # so here we will manually select "Fresh" utxos (with 100,000 satoshis, 1 conf) one at a time
-            fresh_utxo = utxos[i:i+1]
-            txid = self.send(outputs=[], message=lst_of_pushdata, fee=self.fee, combine=False,
-                             custom_pushdata=True, unspents=fresh_utxo)
-            txs.append(txid)
-        return txs
+    def bcat_parts_send_from_binary(self, binary, utxos=None):
+        """Takes in binary data for upload - returns list of txids"""
+        rawtxs = self.bcat_parts_create_from_binary(binary, utxos=utxos)
+        return self.send_rawtxs(rawtxs)
 
     def bcat_parts_send_from_file(self, file, utxos=None):
         if utxos is None:
@@ -231,16 +530,17 @@ class Upload(bitsv.PrivateKey):
         if utxos is None:
             utxos = self.filter_utxos_for_bcat()
         # FIXME - add checks
-        lst_of_pushdata = [(BCAT, 'utf-8'),
-                           (info, "utf-8"),  # B:// protocol prefix
-                           (media_type, 'utf-8'),
-                           (encoding, "utf-8"),
-                           (file_name, "utf-8"),  # Optional if no filename
-                           (flags, "utf-8")]  # Optional
-
-        lst_of_pushdata.extend([(tx, 'hex') for tx in lst_of_txids])
-        lst_of_pushdata = op_return.create_pushdata(lst_of_pushdata)
-        return self.create_transaction(outputs=[], message=lst_of_pushdata, combine=False, custom_pushdata=True, unspents=utxos[-1:], fee=self.fee)
+        lst_of_pushdata = [BCAT.encode('utf-8'),
+                           info.encode('utf-8'),  # B:// protocol prefix
+                           media_type.encode('utf-8'),
+                           encoding.encode('utf-8'),
+                           file_name.encode('utf-8'),  # Optional if no filename
+                           flags.encode('utf-8')]  # Optional
+
+        lst_of_pushdata.extend([bytes.fromhex(tx) for tx in lst_of_txids])
+        with self.metrics.stage('create_pushdata'):
+            lst_of_pushdata = op_return.create_pushdata(lst_of_pushdata)
+        return self.op_return_create_rawtx(lst_of_pushdata, utxos[-1:])
 
     def bcat_linker_send_from_txids(self, lst_of_txids, media_type, encoding, file_name=' ', info=' ', flags=' ', utxos=None):
         """Creates and sends bcat transaction to link up "bcat parts" (with the stored data).
@@ -252,51 +552,193 @@ class Upload(bitsv.PrivateKey):
                                                    flags=flags, utxos=utxos[-1:])
         return self.send_rawtx(rawtx)
 
-    def upload_bcat(self, file, media_type=None, encoding=None, file_name=None, utxos=None, txids=None):
+    def upload_bcat(self, file, media_type=None, encoding=None, file_name=None, utxos=None, txids=None,
+                    compress=False, journal=None, max_processes=1):
         """broadcasts bcat parts and then bcat linker tx. Returns txid of linker.
         Extracts defaults for the media_type, encoding and filename from the file path
-        Alternatively these parameters can be overridden as required"""
-        if media_type is None:
-            media_type = self.get_media_type_for_file_name(file)
-        if encoding is None:
-            encoding = self.get_encoding_for_file_name(file)
-        if file_name is None:
-            file_name = self.get_filename(file)
+        Alternatively these parameters can be overridden as required
+
+        With compress=True the file is gzipped (and the linker flagged 'gzip') unless its media type is
+        already compressed or gzip would not make it smaller
+
+        journal is an optional path for an UploadJournal. Every signed tx is recorded there before anything
+        is broadcast. If the upload is interrupted, calling upload_bcat again with the same file and journal
+        broadcasts only the txs that did not make it. The journal is removed once the linker is sent.
+
+        With a dedup_index the linker of an identical file is returned without uploading anything, and
+        parts already on chain are linked to rather than uploaded again.
+
+        max_processes > 1 (or None for one per core) signs the parts in parallel processes"""
+        if journal is not None:
+            journal = UploadJournal(journal)
+            if journal.is_resumable():
+                return self.bcat_resume_from_journal(file, journal)
+        binary = self.file_to_binary(file) if txids is None else None
+        media_type, encoding, file_name = self.file_metadata(file, binary, media_type, encoding, file_name)
         if utxos is None:
             utxos = self.filter_utxos_for_bcat()
+        rawtxs = []
+        new_parts = []
+        sha256 = None
+        flags = ' '
         if txids is None:
-            txids = self.bcat_parts_send_from_file(file, utxos)
-        txid = self.bcat_linker_send_from_txids(lst_of_txids=txids,
-                                                media_type=media_type,
-                                                file_name=file_name,
-                                                encoding=encoding,
-                                                utxos=utxos[-1:])
+            sha256 = hashlib.sha256(binary).hexdigest()
+            if self.dedup_index is not None:
+                txid = self.dedup_index.get_file(sha256, media_type)
+                if txid is not None:
+                    return txid
+            if journal is not None:
+                journal.start(file_size=len(binary), sha256=sha256)
+            if compress and self.is_compressible(media_type):
+                compressed = self.gzip_binary(binary)
+                if len(compressed) < len(binary):
+                    binary, flags = compressed, 'gzip'
+            # txids are known as soon as the parts are signed so the linker is built before any broadcast
+            if self.dedup_index is not None:
+                txids, new_parts = self.bcat_parts_create_deduplicated(binary, utxos=utxos, journal=journal)
+                rawtxs = [rawtx for _, _, rawtx in new_parts]
+            else:
+                rawtxs = self.bcat_parts_create_from_binary(binary, utxos=utxos, journal=journal,
+                                                            max_processes=max_processes)
+                txids = [self.calculate_txid(rawtx) for rawtx in rawtxs]
+        elif journal is not None:
+            journal.start()
+        linker_rawtx = self.bcat_linker_create_from_txids(txids, media_type, encoding, file_name, flags=flags,
+                                                          utxos=utxos[-1:])
+        if journal is not None:
+            journal.set_linker(linker_rawtx, self.calculate_txid(linker_rawtx))
+            linker_txid = self.bcat_send_from_journal(journal)
+        else:
+            self.send_rawtxs(rawtxs)
+            linker_txid = self.send_rawtx(linker_rawtx)
+        if self.dedup_index is not None and sha256 is not None:
+            self.dedup_index.add_parts((part_sha256, length, self.calculate_txid(rawtx))
+                                       for part_sha256, length, rawtx in new_parts)
+            self.dedup_index.add_file(sha256, media_type, BCAT, linker_txid)
+        return linker_txid
+
+    def bcat_send_from_journal(self, journal):
+        """Broadcasts the parts in journal not yet sent, then the linker. Returns txid of linker"""
+        self.send_rawtxs([rawtx for _, rawtx in journal.unsent_parts()], journal=journal)
+        txid = self.send_rawtx_journaled(journal.linker['rawtx'], journal)
+        journal.remove()
         return txid
 
-    def upload_easy(self, file):
-        """Convenience function to upload any file to the blockchain.
-        Picks BCAT:// or B:// depending on filesize.
-        Extracts the media_type, encoding and filename from the file path. Returns txid of
-        result."""
-        size = os.path.getsize(file)
-        num_bcat_parts = self.get_number_bcat_parts(size)
-        if sum([utxo.amount//MAX_DATA_CARRIER_SIZE for utxo in self.get_unspents()]) < num_bcat_parts:
-            if (self.balance < size + 200000):
-                raise ValueError("Not enough funds: send " + str(size + 200000 - self.balance) +
+    def bcat_resume_from_journal(self, file, journal):
+        """Resumes an interrupted upload_bcat of file. Returns txid of linker"""
+        if not isinstance(journal, UploadJournal):
+            journal = UploadJournal(journal)
+        if not journal.is_resumable():
+            raise ValueError('journal ' + journal.path + ' has nothing to resume')
+        if 'sha256' in journal.header:
+            binary = self.file_to_binary(file)
+            if hashlib.sha256(binary).hexdigest() != journal.header['sha256']:
+                raise ValueError('journal ' + journal.path + ' is for a different file than ' + str(file))
+        return self.bcat_send_from_journal(journal)
+
+    def fits_in_b_tx(self, size):
+        """True if a file of size bytes is uploaded in one B:// tx (its data and B_SCRIPT_OVERHEAD fit within
+        max_data_carrier_size) - otherwise it is split into BCAT:// parts"""
+        return size + B_SCRIPT_OVERHEAD <= self.max_data_carrier_size
+
+    def fresh_utxos_needed(self, size):
+        """Number of 'Fresh' utxos needed to upload a file of size bytes with upload_easy:
+        one per BCAT part plus one for the linker - or, for B://, enough to pay for the whole tx
+        (each utxo spent adding an input of its own)"""
+        if self.fits_in_b_tx(size):
+            amount = self.fresh_utxo_amount() - self.fee * P2PKH_INPUT_SIZE
+            return max(int(math.ceil(self.fee * (size + B_SCRIPT_OVERHEAD + B_TX_OVERHEAD) / amount)), 1)
+        return self.get_number_bcat_parts(size, self.bcat_part_space(self.fresh_utxo_amount())) + 1
+
+    def prepare_fresh_utxos(self, num_fresh_utxos, total_size, zero_conf=False):
+        """Makes sure there are at least num_fresh_utxos 'Fresh' utxos (for uploading total_size bytes),
+        consolidating and splitting coins as needed. Returns the 'Fresh' utxos.
+
+        If utxos need splitting first, by default this waits for the split to confirm
+        (utxo_min_confirmations). With zero_conf=True the unconfirmed outputs of the split are returned
+        straight away instead"""
+        min_confirmations = 0 if zero_conf else self.utxo_min_confirmations
+        if sum([utxo.amount//self.fresh_utxo_amount() for utxo in self.get_unspents()]) < num_fresh_utxos:
+            if (self.balance < total_size + 200000):
+                raise ValueError("Not enough funds: send " + str(total_size + 200000 - self.balance) +
                                  " to " + self.address)
             else:
                 # coins need consolidation
                 self.send([])
-        if sum([utxo.amount//MAX_DATA_CARRIER_SIZE for
-                utxo in self.filter_utxos_for_bcat()]) < num_bcat_parts:
+        if len(self.filter_utxos_for_bcat(min_confirmations)) < num_fresh_utxos:
             # funds present but not ready
             self.split_all_utxos()
-            print("Funds present but waiting network confirmation ...", file=sys.stderr)
-            while sum([utxo.amount//MAX_DATA_CARRIER_SIZE for
-                       utxo in self.filter_utxos_for_bcat()]) < num_bcat_parts:
-                time.sleep(60)
-            print("Got network confirmation", file=sys.stderr)
-        if size < MAX_DATA_CARRIER_SIZE:
-            return self.upload_b(file)
+            if not zero_conf:
+                print("Funds present but waiting network confirmation ...", file=sys.stderr)
+                with self.metrics.stage('wait_confirmation'):
+                    while len(self.filter_utxos_for_bcat()) < num_fresh_utxos:
+                        time.sleep(60)
+                        self.refresh_unspents()
+                print("Got network confirmation", file=sys.stderr)
+        # the split (if any) was accepted by send_rawtx so its outputs are already in the local utxo set
+        return self.filter_utxos_for_bcat(min_confirmations)
+
+    def upload_easy(self, file, zero_conf=False, compress=False):
+        """Convenience function to upload any file to the blockchain.
+        Picks BCAT:// or B:// depending on filesize.
+        Extracts the media_type, encoding and filename from the file path. Returns txid of
+        result.
+
+        If utxos need splitting first, by default this waits for the split to confirm
+        (utxo_min_confirmations). With zero_conf=True the unconfirmed outputs of the split are spent
+        straight away instead - the split is broadcast first, then the parts, then the linker.
+
+        compress=True gzips compressible files uploaded via BCAT:// (see upload_bcat). Files already in
+        dedup_index are not uploaded again (and need no utxos)"""
+        if self.dedup_index is not None:
+            txid = self.dedup_index.get_file(sha256_file(file), self.get_media_type_for_file_name(file))
+            if txid is not None:
+                return txid
+        size = os.path.getsize(file)
+        utxos = self.prepare_fresh_utxos(self.fresh_utxos_needed(size), size, zero_conf=zero_conf)
+        if self.fits_in_b_tx(size):
+            return self.upload_b(file, utxos=utxos)
         else:
-            return self.upload_bcat(file)
+            return self.upload_bcat(file, utxos=utxos, compress=compress)
+
+    def upload_batch(self, files, zero_conf=False, compress=False, max_concurrent=DEFAULT_MAX_WORKERS):
+        """Uploads many files (as upload_easy would) - yields (file, txid) as each upload completes, or
+        (file, exception) if it failed (the rest of the batch carries on).
+
+        The 'Fresh' utxos for the whole batch are prepared up front (one consolidation / split and at
+        most one wait for confirmation) and each file is given its own, so up to max_concurrent files
+        are uploaded at once without competing for utxos"""
+        files = list(files)
+        pending = []
+        for file in files:
+            if self.dedup_index is not None:
+                txid = self.dedup_index.get_file(sha256_file(file), self.get_media_type_for_file_name(file))
+                if txid is not None:
+                    yield file, txid
+                    continue
+            pending.append((file, os.path.getsize(file)))
+        if not pending:
+            return
+        needed = [self.fresh_utxos_needed(size) for _, size in pending]
+        utxos = self.prepare_fresh_utxos(sum(needed), sum(size for _, size in pending), zero_conf=zero_conf)
+        if len(utxos) < sum(needed):
+            raise ValueError("insufficient 'Fresh' unspent transaction outputs (utxos) for the batch (" +
+                             str(len(utxos)) + " < " + str(sum(needed)) + ")")
+
+        def upload(file, size, file_utxos):
+            if self.fits_in_b_tx(size):
+                return self.upload_b(file, utxos=file_utxos)
+            return self.upload_bcat(file, utxos=file_utxos, compress=compress)
+
+        with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+            futures = {}
+            offset = 0
+            for (file, size), num_utxos in zip(pending, needed):
+                future = executor.submit(upload, file, size, utxos[offset:offset + num_utxos])
+                futures[future] = file
+                offset += num_utxos
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
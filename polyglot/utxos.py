@@ -0,0 +1,81 @@
+import threading
+import time
+
+from bitsv.network.meta import Unspent
+
+from .rawtx import deserialize_rawtx
+
+# Seconds before the local utxo set is reconciled with the network again (None = only on demand)
+DEFAULT_MAX_AGE = 60
+
+
+class UtxoTracker:
+    """Local view of the unspent outputs of one address.
+
+    The network is queried once and then outputs spent / created by our own broadcasts are applied
+    locally (see record_rawtx). The set is only reconciled with the network when refresh() is called
+    or when it is older than max_age seconds. Outputs we spent or created are remembered until the
+    network has caught up with them, so a refresh never resurrects a spent utxo or drops a fresh one.
+
+    :param fetch_unspents: callable returning the network's list of Unspent for the address
+    :param script: the address' locking script (bytes) - used to recognise our outputs in a rawtx
+    """
+    def __init__(self, fetch_unspents, script, max_age=DEFAULT_MAX_AGE):
+        self.fetch_unspents = fetch_unspents
+        self.script = script
+        self.max_age = max_age
+        self.last_refresh = None
+        self._lock = threading.RLock()
+        self._unspents = {}  # (txid, txindex) -> Unspent
+        self._spent = set()  # outpoints spent locally that the network may still report
+        self._created = {}  # outpoints created locally that the network may not report yet
+
+    def is_stale(self):
+        if self.last_refresh is None:
+            return True
+        return self.max_age is not None and time.monotonic() - self.last_refresh > self.max_age
+
+    def refresh(self, network_unspents=None):
+        """Re-queries the network and merges in local changes it has not seen yet.
+        network_unspents can be passed in if they were fetched some other way (e.g. asynchronously)"""
+        if network_unspents is None:
+            network_unspents = self.fetch_unspents()
+        with self._lock:
+            network = {(utxo.txid, utxo.txindex): utxo for utxo in network_unspents}
+            self._spent &= network.keys()
+            for outpoint in list(self._created):
+                if outpoint in network:
+                    del self._created[outpoint]
+            self._unspents = {outpoint: utxo for outpoint, utxo in network.items() if outpoint not in self._spent}
+            self._unspents.update(self._created)
+            self.last_refresh = time.monotonic()
+
+    def get(self):
+        """returns unspents in the same order as bitsv (most confirmations, then smallest amount first)"""
+        if self.is_stale():
+            self.refresh()
+        with self._lock:
+            return sorted(self._unspents.values(), key=lambda utxo: (-utxo.confirmations, utxo.amount))
+
+    def spend(self, txid, txindex):
+        with self._lock:
+            self._spent.add((txid, txindex))
+            self._created.pop((txid, txindex), None)
+            self._unspents.pop((txid, txindex), None)
+
+    def add(self, utxo):
+        with self._lock:
+            outpoint = (utxo.txid, utxo.txindex)
+            if outpoint not in self._spent:
+                self._created[outpoint] = utxo
+                self._unspents[outpoint] = utxo
+
+    def record_rawtx(self, rawtx, txid):
+        """Applies a broadcast transaction: spends its inputs and adds its outputs paying to our script"""
+        inputs, outputs = deserialize_rawtx(rawtx)
+        with self._lock:
+            for txin in inputs:
+                self.spend(txin.txid, txin.txindex)
+            for txindex, output in enumerate(outputs):
+                if output.script == self.script:
+                    self.add(Unspent(amount=output.amount, confirmations=0, txid=txid, txindex=txindex))
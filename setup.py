@@ -51,6 +51,7 @@ setup(
     extras_require={
         'cli': ('appdirs', 'click', 'privy', 'tinydb'),
         'cache': ('lmdb', ),
+        'async': ('aiohttp', ),
     },
     tests_require=['pytest'],
     packages=find_packages(),
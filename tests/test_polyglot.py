@@ -1,10 +1,41 @@
+import asyncio
+import gzip
+import io
 import polyglot
 import os
+import pytest
+import threading
+from bitsv.network.meta import Unspent
 
 my_path = os.path.abspath(os.path.dirname(__file__))
 
 # ICONS
 PATH_TO_SMALL_JPG = os.path.join(my_path, './test_content/images/Ludwig_von_Mises.jpg')
+PATH_TO_LARGE_JPG = os.path.join(my_path, './test_content/images/BSV_banner.jpg')
+
+
+def fresh_utxos(n, amount=100000):
+    return [Unspent(amount=amount, confirmations=1, txid='%064x' % i, txindex=0) for i in range(n)]
+
+
+class RecordingUpload(polyglot.Upload):
+    """Keeps the rawtxs it would broadcast in 'broadcast' - nothing is sent"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.broadcast = []
+
+    def send_rawtx(self, rawtx):
+        self.broadcast.append(rawtx)
+        return self.calculate_txid(rawtx)
+
+
+def funded_chain(amount=2000000, count=1, **kwargs):
+    """returns (FakeChain, Upload on it) - the Upload's address paid count outputs of amount satoshis.
+    kwargs go to Upload"""
+    chain = polyglot.FakeChain()
+    uploader = polyglot.Upload(backend=chain, **kwargs)
+    chain.fund(uploader.address, amount, count=count)
+    return chain, uploader
 
 
 class TestUpload:
@@ -12,6 +43,496 @@ class TestUpload:
         binary = polyglot.Upload.file_to_binary(PATH_TO_SMALL_JPG)
         assert type(binary) == bytes
 
+    def testbcat_parts_create_from_binary_is_offline(self):
+        uploader = polyglot.Upload()
+        binary = polyglot.Upload.file_to_binary(PATH_TO_LARGE_JPG)
+        rawtxs = uploader.bcat_parts_create_from_binary(binary, utxos=fresh_utxos(10))
+        assert len(rawtxs) == uploader.get_number_bcat_parts(len(binary))
+        assert len(set(uploader.calculate_txid(rawtx) for rawtx in rawtxs)) == len(rawtxs)
+
+    def testbcat_part_sizing(self):
+        space = polyglot.upload.SPACE_AVAILABLE_PER_TX_BCAT_PART
+        assert polyglot.Upload.get_number_bcat_parts(2 * space) == 2
+        assert polyglot.Upload.get_number_bcat_parts(2 * space + 1) == 3
+        uploader = polyglot.Upload(max_data_carrier_size=1_000_000)
+        rawtxs = uploader.bcat_parts_create_from_binary(bytes(500_000), utxos=fresh_utxos(3, amount=1_000_000))
+        assert len(rawtxs) == 1
+        assert len(rawtxs[0]) // 2 <= 1_000_000  # tx size in bytes is covered by the utxo at 1 sat/byte
+
+    def testbuild_rawtxs_in_processes(self):
+        uploader = polyglot.Upload()
+        jobs = [(os.urandom(1000), utxo) for utxo in fresh_utxos(5)]
+        in_process = uploader.build_rawtxs('bcat_part_create_from_binary', jobs, max_processes=1)
+        assert uploader.build_rawtxs('bcat_part_create_from_binary', jobs, max_processes=2) == in_process
+        assert in_process[1] == [uploader.calculate_txid(rawtx) for rawtx in in_process[0]]
+
+    def testgzip_binary_is_one_gzip_file(self):
+        uploader = polyglot.Upload(max_workers=4)
+        binary = b'{"json": "compresses well"}\n' * 200000
+        compressed = uploader.gzip_binary(binary)
+        assert len(compressed) < len(binary)
+        assert gzip.decompress(compressed) == binary
+        assert b''.join(polyglot.Download.gunzip_chunks([compressed])) == binary
+        assert not uploader.is_compressible('image/jpeg') and uploader.is_compressible('application/json')
+
+    def testsniff_metadata(self, tmp_path):
+        sniffer = polyglot.MetadataSniffer()
+        assert sniffer.sniff(PATH_TO_SMALL_JPG) == ('image/jpeg', 'binary', 'Ludwig_von_Mises.jpg')
+        # no extension - libmagic is given the contents from memory, the file is never opened
+        binary = polyglot.Upload.file_to_binary(PATH_TO_SMALL_JPG)
+        assert sniffer.sniff(str(tmp_path / 'missing'), binary) == ('image/jpeg', 'binary', 'missing')
+        page = tmp_path / 'index.html'
+        page.write_bytes('<html>héllo</html>'.encode('utf-8'))
+        assert sniffer.sniff(str(page)) == ('text/html', 'utf-8', 'index.html')
+        assert polyglot.MetadataSniffer(extensions={}).sniff(PATH_TO_SMALL_JPG).media_type == 'image/jpeg'
+        uploader = polyglot.Upload()
+        assert uploader.file_metadata(str(page), encoding='latin-1') == ('text/html', 'latin-1', 'index.html')
+
+    def testupload_bcat_resumes_from_journal(self, tmp_path):
+        class FlakyUpload(RecordingUpload):
+            fail_after = 2
+
+            def send_rawtx(self, rawtx):
+                if len(self.broadcast) == self.fail_after:
+                    raise ConnectionError
+                return super().send_rawtx(rawtx)
+
+        journal = str(tmp_path / 'upload.journal')
+        uploader = FlakyUpload(max_workers=1)
+        try:
+            uploader.upload_bcat(PATH_TO_LARGE_JPG, utxos=fresh_utxos(10), journal=journal)
+        except ConnectionError:
+            pass
+        assert polyglot.UploadJournal(journal).is_resumable()
+        sent = uploader.broadcast
+        uploader.broadcast, uploader.fail_after = [], None
+        txid = uploader.upload_bcat(PATH_TO_LARGE_JPG, journal=journal)
+        assert not set(sent) & set(uploader.broadcast)
+        assert uploader.calculate_txid(uploader.broadcast[-1]) == txid
+        assert not os.path.exists(journal)
+
+    def testupload_bcat_dedup(self, tmp_path):
+        uploader = RecordingUpload(dedup_index=polyglot.DedupIndex(str(tmp_path / 'dedup.sqlite')))
+        linker = uploader.upload_bcat(PATH_TO_LARGE_JPG, utxos=fresh_utxos(10))
+        num_parts = len(uploader.broadcast) - 1
+        assert uploader.upload_bcat(PATH_TO_LARGE_JPG, utxos=fresh_utxos(10)) == linker
+        assert len(uploader.broadcast) == num_parts + 1
+        # the same content with a little appended only needs a new last part (and linker)
+        extended = tmp_path / 'extended.jpg'
+        extended.write_bytes(polyglot.Upload.file_to_binary(PATH_TO_LARGE_JPG) + b'more')
+        uploader.broadcast = []
+        uploader.upload_bcat(str(extended), utxos=fresh_utxos(10))
+        assert len(uploader.broadcast) == 2
+
+    def testupload_bcat_dedup_compressed(self, tmp_path, monkeypatch):
+        uploader = RecordingUpload(dedup_index=polyglot.DedupIndex(str(tmp_path / 'dedup.sqlite')))
+        text = os.urandom(polyglot.upload.GZIP_CHUNK_SIZE // 2).hex().encode('utf-8')
+        first, second = tmp_path / 'first.txt', tmp_path / 'second.txt'
+        first.write_bytes(text)
+        second.write_bytes(text + b'more')
+        uploader.upload_bcat(str(first), utxos=fresh_utxos(20), compress=True)
+        assert len(uploader.broadcast) > 3
+        # compressed later: the gzip headers must not depend on the time
+        monkeypatch.setattr(gzip.time, 'time', lambda: 1234567890)
+        uploader.broadcast = []
+        uploader.upload_bcat(str(second), utxos=fresh_utxos(20), compress=True)
+        assert len(uploader.broadcast) == 2
+
+    def testupload_batch_gives_each_file_its_own_utxos(self):
+        class FundedUpload(RecordingUpload):
+            def get_unspents(self):
+                return fresh_utxos(10)
+
+        uploader = FundedUpload()
+        results = dict(uploader.upload_batch([PATH_TO_SMALL_JPG, PATH_TO_LARGE_JPG], max_concurrent=2))
+        assert set(results) == {PATH_TO_SMALL_JPG, PATH_TO_LARGE_JPG}
+        assert all(isinstance(txid, str) for txid in results.values())
+        outpoints = [(tx_input.txid, tx_input.txindex) for rawtx in uploader.broadcast
+                     for tx_input in polyglot.rawtx.deserialize_rawtx(rawtx)[0]]
+        assert len(outpoints) == len(set(outpoints))
+
+
+class TestDownload:
+    def testimap_txids_keeps_order(self):
+        downloader = polyglot.Download(max_workers=4)
+        txids = [str(i) for i in range(50)]
+        assert list(downloader.imap_txids(lambda txid: txid * 2, txids)) == [txid * 2 for txid in txids]
+
+    def testpushdata_views_from_script(self):
+        prefix = polyglot.BCATPART.encode('utf-8')
+        script = b'\x00\x6a' + bytes([len(prefix)]) + prefix + b'\x4d\x00\x01' + bytes(256)
+        data = polyglot.Download.pushdata_views_from_script(script)
+        assert all(isinstance(push, memoryview) for push in data)
+        assert data == [b'', prefix, bytes(256)]
+        assert polyglot.Download.pushdata_from_script(script.hex()) == [b'', prefix, bytes(256)]
+        # falls back to the full parser for non-push opcodes
+        assert polyglot.Download.pushdata_views_from_script(b'\x00\x6a\x51\x02ab') == [b'', b'\x01', b'ab']
+        assert polyglot.Download.pushdata_views_from_script(b'\x76\xa9') == []
+
+    def testscript_views_from_rawtx(self):
+        uploader = polyglot.Upload()
+        rawtx = uploader.create_transaction([], fee=1, combine=False, message=b'hello', unspents=fresh_utxos(1))
+        scripts = polyglot.Download.script_views_from_rawtx(bytes.fromhex(rawtx))
+        assert polyglot.Download.pushdata_from_script(scripts[0].hex()) == [b'', b'hello']
+        assert bytes(scripts[1]) == uploader.scriptcode
+
+    def testgunzip_chunks(self):
+        binary = os.urandom(3000) * 1000
+        stream = gzip.compress(binary)
+        chunks = [stream[i:i + 7000] for i in range(0, len(stream), 7000)]
+        assert b''.join(polyglot.Download.gunzip_chunks(chunks)) == binary
+        # one gzip member per part
+        parts = [gzip.compress(binary[i:i + 100000]) for i in range(0, len(binary), 100000)]
+        assert b''.join(polyglot.Download.gunzip_chunks(parts)) == binary
+        # zero padding after a member (split across chunks, or followed by another member) is skipped
+        padded = [stream + b'\x00' * 3, b'\x00' * 5]
+        assert b''.join(polyglot.Download.gunzip_chunks(padded)) == gzip.decompress(b''.join(padded)) == binary
+        padded = [parts[0] + b'\x00' * 8 + parts[1]] + parts[2:] + [b'\x00' * 4]
+        assert b''.join(polyglot.Download.gunzip_chunks(padded)) == binary
+
+    def testdownload_bcat_resume_and_verify(self, tmp_path):
+        parts = {'%064x' % i: os.urandom(1000 + i) for i in range(60)}
+
+        class FlakyDownload(polyglot.Download):
+            fail_after = 40
+
+            def bcat_linker_fields_from_txid(self, txid):
+                return {'flag': ' ', 'parts': list(parts)}
+
+            def bcat_part_binaries_from_txids(self, txids):
+                if self.fail_after is not None and len(self.fetched) >= self.fail_after:
+                    raise ConnectionError
+                self.fetched.extend(txids)
+                return [parts[txid] for txid in txids]
+
+        file = str(tmp_path / 'file')
+        downloader = FlakyDownload(max_workers=1)
+        downloader.fetched = []
+        try:
+            downloader.download_bcat('linker', file, resume=True)
+        except ConnectionError:
+            pass
+        downloader.fetched, downloader.fail_after = [], None
+        downloader.download_bcat('linker', file, resume=True)
+        assert downloader.fetched == list(parts)[40:]
+        with open(file, 'rb') as f:
+            assert f.read() == b''.join(parts.values())
+        assert downloader.verify_bcat('linker', file) == []
+        with open(file, 'r+b') as f:
+            f.seek(len(parts['%064x' % 0]) + 1)
+            f.write(b'x')
+        assert downloader.verify_bcat('linker', file) == [1]
+
+    def testdownload_detects_b_and_bcat(self, tmp_path):
+        uploader = polyglot.Upload()
+        downloader = polyglot.Download()
+        small = polyglot.Upload.file_to_binary(PATH_TO_SMALL_JPG)
+        large = polyglot.Upload.file_to_binary(PATH_TO_LARGE_JPG)
+        b_rawtx = uploader.b_create_rawtx_from_binary(small, 'image/jpeg', file_name='small.jpg',
+                                                      utxos=fresh_utxos(1))
+        part_rawtxs = uploader.bcat_parts_create_from_binary(large, utxos=fresh_utxos(10))
+        part_txids = [uploader.calculate_txid(rawtx) for rawtx in part_rawtxs]
+        linker_rawtx = uploader.bcat_linker_create_from_txids(part_txids, 'image/jpeg', ' ', 'large.jpg',
+                                                              utxos=fresh_utxos(1))
+        for rawtx in [b_rawtx, linker_rawtx] + part_rawtxs:
+            downloader.cache.put(uploader.calculate_txid(rawtx), bytes.fromhex(rawtx))
+        downloader.download(uploader.calculate_txid(b_rawtx), str(tmp_path))
+        assert (tmp_path / 'small.jpg').read_bytes() == small
+        stream = io.BytesIO()
+        downloader.download(uploader.calculate_txid(linker_rawtx), stream)
+        assert stream.getvalue() == large
+
+    def testdownload_nameless_to_directory(self, tmp_path):
+        uploader = polyglot.Upload()
+        downloader = polyglot.Download()
+        small = polyglot.Upload.file_to_binary(PATH_TO_SMALL_JPG)
+        large = polyglot.Upload.file_to_binary(PATH_TO_LARGE_JPG)
+        b_rawtx = uploader.b_create_rawtx_from_binary(small, 'image/jpeg', file_name=' ', utxos=fresh_utxos(1))
+        part_rawtxs = uploader.bcat_parts_create_from_binary(large, utxos=fresh_utxos(10))
+        part_txids = [uploader.calculate_txid(rawtx) for rawtx in part_rawtxs]
+        linker_rawtx = uploader.bcat_linker_create_from_txids(part_txids, 'image/jpeg', ' ', ' ',
+                                                              utxos=fresh_utxos(1))
+        for rawtx in [b_rawtx, linker_rawtx] + part_rawtxs:
+            downloader.cache.put(uploader.calculate_txid(rawtx), bytes.fromhex(rawtx))
+        b_txid, linker = uploader.calculate_txid(b_rawtx), uploader.calculate_txid(linker_rawtx)
+        downloader.download(b_txid, str(tmp_path))
+        downloader.download(linker, str(tmp_path))
+        # named after the txid
+        assert (tmp_path / b_txid).read_bytes() == small
+        assert (tmp_path / linker).read_bytes() == large
+
+    def testdecode_scripts_splits_bitcom_segments(self):
+        from bitsv import op_return
+        script = b'\x00\x6a' + op_return.create_pushdata([
+            (polyglot.B, 'utf-8'), ('hello', 'utf-8'), ('text/plain', 'utf-8'), ('utf-8', 'utf-8'), ('|', 'utf-8'),
+            (polyglot.MAP, 'utf-8'), ('SET', 'utf-8'), ('app', 'utf-8'), ('polyglot', 'utf-8'), ('|', 'utf-8'),
+            (polyglot.AIP, 'utf-8'), ('BITCOIN_ECDSA', 'utf-8'), ('1address', 'utf-8'), ('c2ln', 'utf-8')])
+        p2pkh = polyglot.Upload().scriptcode
+        segments = polyglot.Download().decode_scripts([p2pkh, script])
+        assert [segment.protocol for segment in segments] == ['B', 'MAP', 'AIP']
+        assert all(segment.txindex == 1 for segment in segments)
+        assert bytes(segments[0].fields['data']) == b'hello'
+        assert segments[1].fields == {'action': 'SET', 'data': {'app': 'polyglot'}}
+        assert segments[2].fields['address'] == '1address'
+
+
+class TestTxCache:
+    def testlru_eviction(self):
+        cache = polyglot.TxCache(max_memory=10)
+        cache.put('a', b'0000')
+        cache.put('b', b'0000')
+        cache.get('a')
+        cache.put('c', b'0000')
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+
+    def testdisk_roundtrip(self, tmp_path):
+        polyglot.TxCache(directory=str(tmp_path)).put('a', b'\x00\x6a')
+        assert polyglot.TxCache(directory=str(tmp_path)).get('a') == b'\x00\x6a'
+
+
+class TestUtxoTracker:
+    def testrecord_rawtx_survives_refresh(self):
+        uploader = polyglot.Upload()
+        network_utxos = fresh_utxos(2)
+        tracker = polyglot.UtxoTracker(lambda: network_utxos, uploader.scriptcode)
+        rawtx = uploader.create_transaction([(uploader.address, 1000, 'satoshi')], fee=1, combine=False,
+                                            unspents=network_utxos[:1])
+        txid = uploader.calculate_txid(rawtx)
+        tracker.record_rawtx(rawtx, txid)
+        tracker.refresh()  # network has not seen the tx yet
+        outpoints = {(utxo.txid, utxo.txindex) for utxo in tracker.get()}
+        assert outpoints == {(network_utxos[1].txid, 0), (txid, 0), (txid, 1)}
+
+
+
+class TestFakeChain:
+    def testupload_download_roundtrip_offline(self):
+        chain, uploader = funded_chain()
+        # the split is spent unconfirmed, so everything happens without mining
+        linker = uploader.upload_easy(PATH_TO_LARGE_JPG, zero_conf=True)
+        b_txid = uploader.upload_easy(PATH_TO_SMALL_JPG, zero_conf=True)
+        assert linker in chain.mempool() and b_txid in chain.mempool()
+        chain.mine()
+        assert not chain.mempool()
+        downloader = polyglot.Download(backend=chain)
+        large, small = io.BytesIO(), io.BytesIO()
+        downloader.download(linker, large)
+        downloader.download(b_txid, small)
+        # nothing bypasses the backend
+        assert downloader.get_unspents(uploader.address) == chain.get_unspents(uploader.address)
+        assert large.getvalue() == polyglot.Upload.file_to_binary(PATH_TO_LARGE_JPG)
+        assert small.getvalue() == polyglot.Upload.file_to_binary(PATH_TO_SMALL_JPG)
+
+    def testb_files_near_the_limit_pay_their_fee(self, tmp_path):
+        chain, uploader = funded_chain()
+        # the largest B:// file and the smallest BCAT:// one
+        limit = uploader.max_data_carrier_size - polyglot.upload.B_SCRIPT_OVERHEAD
+        assert uploader.fits_in_b_tx(limit) and not uploader.fits_in_b_tx(limit + 1)
+        big, bigger = tmp_path / 'big.bin', tmp_path / 'bigger.bin'
+        big.write_bytes(os.urandom(limit))
+        bigger.write_bytes(os.urandom(limit + 1))
+        assert uploader.fresh_utxos_needed(limit) == 2
+        results = dict(uploader.upload_batch([str(big), str(bigger), PATH_TO_SMALL_JPG], zero_conf=True))
+        assert all(isinstance(txid, str) for txid in results.values())
+        downloader = polyglot.Download(backend=chain)
+        assert downloader.b_detect_from_txid(results[str(big)])
+        assert downloader.bcat_linker_detect_from_txid(results[str(bigger)])
+        for file in (big, bigger):
+            stream = io.BytesIO()
+            downloader.download(results[str(file)], stream)
+            assert stream.getvalue() == file.read_bytes()
+        # exactly two 'Fresh' utxos - no split needed
+        chain, uploader = funded_chain(polyglot.Upload().fresh_utxo_amount(), count=2)
+        assert uploader.upload_easy(str(big), zero_conf=True) in chain.txs
+
+    def testb_files_above_100kb_with_a_raised_limit(self, tmp_path):
+        chain, uploader = funded_chain(3_000_000, max_data_carrier_size=1_000_000)
+        big = tmp_path / 'big.bin'
+        big.write_bytes(os.urandom(300_000))
+        txid = uploader.upload_easy(str(big), zero_conf=True)
+        assert polyglot.Download(backend=chain).b_detect_from_txid(txid)
+        stream = io.BytesIO()
+        polyglot.Download(backend=chain).download(txid, stream)
+        assert stream.getvalue() == big.read_bytes()
+
+    def testsend_op_return_goes_through_the_backend(self):
+        chain, uploader = funded_chain(100000)
+        funding, = chain.txs
+        txid = uploader.send_op_return([('hello', 'utf-8')])
+        assert chain.calls['send_rawtx'] == 1 and txid in chain.mempool()
+        assert [utxo.txid for utxo in uploader.get_unspents()] == [txid]
+        assert uploader.get_transactions() == [funding, txid]
+
+    def testrejects_double_spend(self):
+        chain, uploader = funded_chain(100000)
+        utxos = uploader.get_unspents()
+        uploader.send_rawtx(uploader.b_create_rawtx_from_binary(b'a', 'text/plain', utxos=utxos))
+        with pytest.raises(ValueError):
+            uploader.send_rawtx(uploader.b_create_rawtx_from_binary(b'b', 'text/plain', utxos=utxos))
+
+    def testmetrics_per_stage(self):
+        upload_metrics, download_metrics = polyglot.Metrics(profile=['sign']), polyglot.Metrics()
+        chain, uploader = funded_chain(100000, count=10, metrics=upload_metrics)
+        linker = uploader.upload_bcat(PATH_TO_LARGE_JPG, utxos=uploader.filter_utxos_for_bcat())
+        polyglot.Download(backend=chain, metrics=download_metrics).download(linker, io.BytesIO())
+        uploaded = upload_metrics.snapshot()
+        assert uploaded['send_rawtx']['calls'] == chain.calls['send_rawtx']
+        assert uploaded['sign']['calls'] == uploaded['send_rawtx']['calls']
+        assert uploaded['get_unspents']['calls'] == 1
+        assert upload_metrics.profiler.getstats()
+        downloaded = download_metrics.snapshot()
+        assert downloaded['fetch']['calls'] == chain.calls['get_rawtx'] + chain.calls['get_rawtxs']
+        assert downloaded['write']['bytes'] == os.path.getsize(PATH_TO_LARGE_JPG)
+
+
+class TestScanner:
+    def testscan_block_files_and_download_offline(self, tmp_path):
+        from polyglot.scanner import ScanIndex, ScanIndexBackend
+        from bitsv.utils import int_to_varint
+        chain, uploader = funded_chain()
+        linker = uploader.upload_easy(PATH_TO_LARGE_JPG, zero_conf=True)
+        b_txid = uploader.upload_easy(PATH_TO_SMALL_JPG, zero_conf=True)
+        rawtxs = list(chain.txs.values())
+
+        def block(txs):
+            return b'\x00' * 80 + int_to_varint(len(txs)) + b''.join(txs)
+        # a preallocated blk file with two blocks, then the b tx on its own in a raw tx dump
+        blocks = [block(rawtxs[:3]), block(rawtxs[3:-1])]
+        (tmp_path / 'blk00000.dat').write_bytes(
+            b''.join(b'\xf9\xbe\xb4\xd9' + len(b).to_bytes(4, 'little') + b for b in blocks) + b'\x00' * 1000)
+        (tmp_path / 'txs.bin').write_bytes(rawtxs[-1])
+
+        index = ScanIndex(str(tmp_path / 'index.db'))
+        paths = [str(tmp_path / 'blk00000.dat'), str(tmp_path / 'txs.bin')]
+        assert index.scan(paths, max_workers=2) == 4  # linker, 2 parts and the b tx
+        assert index.scan(paths) == 0  # unchanged files are skipped
+        fields = index.get(linker)
+        assert fields['protocol'] == 'BCAT' and fields['mediatype'] == 'image/jpeg'
+        assert fields['size'] == os.path.getsize(PATH_TO_LARGE_JPG) and len(fields['parts']) == 2
+        assert index.find('B') == [b_txid]
+        assert index.get(b_txid)['size'] == os.path.getsize(PATH_TO_SMALL_JPG)
+
+        downloader = polyglot.Download(backend=ScanIndexBackend(index))
+        large, small = io.BytesIO(), io.BytesIO()
+        downloader.download(linker, large)
+        downloader.download(b_txid, small)
+        assert large.getvalue() == polyglot.Upload.file_to_binary(PATH_TO_LARGE_JPG)
+        assert small.getvalue() == polyglot.Upload.file_to_binary(PATH_TO_SMALL_JPG)
+        with pytest.raises(ValueError):
+            ScanIndexBackend(index).get_rawtx('00' * 32)
+
+
+class TestBcatReader:
+    def testseek_and_read_ranges(self):
+        chain, uploader = funded_chain(100000, count=30, max_data_carrier_size=10000)
+        linker = uploader.upload_bcat(PATH_TO_LARGE_JPG, utxos=uploader.filter_utxos_for_bcat())
+        binary = polyglot.Upload.file_to_binary(PATH_TO_LARGE_JPG)
+        reader = polyglot.BcatReader(linker, downloader=polyglot.Download(backend=chain), prefetch=0)
+        reader.seek(50000)
+        assert reader.read(3000) == binary[50000:53000]
+        assert len(reader.parts) > 10 and reader.size == len(binary)
+        assert reader.seek(-10, io.SEEK_END) == len(binary) - 10
+        assert reader.read() == binary[-10:] and reader.read() == b''
+        reader.seek(0)
+        assert io.BufferedReader(reader, 4096).read() == binary
+        # with the part sizes known up front only the part covering the range is fetched
+        part_sizes = [end - start for start, end in zip(reader._offsets, reader._offsets[1:])]
+        reader = polyglot.BcatReader(linker, downloader=polyglot.Download(backend=chain), prefetch=0,
+                                     part_sizes=part_sizes)
+        fetched = chain.calls['get_rawtxs']
+        reader.seek(50000)
+        assert reader.read(3000) == binary[50000:53000]
+        assert chain.calls['get_rawtxs'] == fetched + 1 and len(reader._cache) == 1
+
+    def testuneven_parts_are_never_misread(self):
+        chain, uploader = funded_chain(100000, count=8)
+        utxos = uploader.filter_utxos_for_bcat()
+        chunks = [os.urandom(size) for size in (1000, 300, 1000, 1000, 500)]
+        binary = b''.join(chunks)
+        txids = [chain.send_rawtx(uploader.bcat_part_create_from_binary(chunk, utxo))
+                 for chunk, utxo in zip(chunks, utxos)]
+
+        def linker(part_txids, utxo):
+            return chain.send_rawtx(uploader.bcat_linker_create_from_txids(part_txids, 'application/octet-stream',
+                                                                           ' ', ' ', utxos=[utxo]))
+        bcat = linker(txids, utxos[5])
+        downloader = polyglot.Download(backend=chain)
+        with polyglot.BcatReader(bcat, downloader=downloader, prefetch=2) as reader:
+            reader.seek(2500)
+            assert reader.read(100) == binary[2500:2600]
+            assert reader.size == 3800
+            reader.seek(0)
+            assert b''.join(iter(lambda: reader.read(700), b'')) == binary
+        with pytest.raises(ValueError):
+            polyglot.BcatReader(bcat, downloader=downloader, part_sizes=[1000] * 4 + [500]).read()
+        # a linker listing a tx that is not a BCAT part
+        b_txid = chain.send_rawtx(uploader.b_create_rawtx_from_binary(b'hello', 'text/plain', utxos=utxos[6:7]))
+        with pytest.raises(ValueError):
+            polyglot.BcatReader(linker([b_txid], utxos[7]), downloader=downloader).read()
+
+
+class TestAsync:
+    async def fake_api(self):
+        """Serves the whatsonchain endpoints used by AsyncUpload / AsyncDownload from memory"""
+        web = pytest.importorskip('aiohttp.web')
+        txs = {}
+
+        async def unspent(request):
+            return web.json_response([{'height': 1, 'tx_pos': 0, 'tx_hash': utxo.txid, 'value': utxo.amount}
+                                      for utxo in fresh_utxos(10)])
+
+        async def chain_info(request):
+            return web.json_response({'blocks': 10})
+
+        async def broadcast(request):
+            rawtx = (await request.json())['txhex']
+            txid = polyglot.Upload.calculate_txid(rawtx)
+            txs[txid] = rawtx
+            return web.json_response(txid)
+
+        async def tx_hex(request):
+            return web.Response(text=txs[request.match_info['txid']])
+
+        async def txs_hex(request):
+            return web.json_response([{'txid': txid, 'hex': txs[txid]} for txid in (await request.json())['txids']])
+
+        app = web.Application()
+        app.add_routes([web.get('/address/{address}/unspent', unspent), web.get('/chain/info', chain_info),
+                        web.post('/tx/raw', broadcast), web.get('/tx/{txid}/hex', tx_hex),
+                        web.post('/txs/hex', txs_hex)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        return runner, 'http://127.0.0.1:{}'.format(runner.addresses[0][1])
+
+    def testupload_and_download_roundtrip(self, tmp_path):
+        aiohttp = pytest.importorskip('aiohttp')
 
+        class ThreadRecordingSink(io.BytesIO):
+            def write(self, data):
+                self.threads.add(threading.get_ident())
+                return super().write(data)
 
+        async def roundtrip():
+            async with aiohttp.ClientSession() as session:
+                uploader = polyglot.AsyncUpload(session=session, max_concurrency=4)
+                runner, url = await self.fake_api()
+                uploader.api_url = url
+                downloader = polyglot.AsyncDownload(session=session, api_url=url, max_concurrency=4)
+                b_txid = await uploader.upload_b(PATH_TO_SMALL_JPG)
+                bcat_txid = await uploader.upload_bcat(PATH_TO_LARGE_JPG, compress=True)
+                small, large = ThreadRecordingSink(), ThreadRecordingSink()
+                small.threads, large.threads = set(), set()
+                await downloader.download_b(b_txid, small)
+                await downloader.download_bcat(bcat_txid, large)
+                await downloader.download_bcat(bcat_txid, str(tmp_path / 'large.jpg'))
+                await runner.cleanup()
+            return small, large
 
+        small, large = asyncio.run(roundtrip())
+        assert small.getvalue() == polyglot.Upload.file_to_binary(PATH_TO_SMALL_JPG)
+        assert large.getvalue() == polyglot.Upload.file_to_binary(PATH_TO_LARGE_JPG)
+        assert (tmp_path / 'large.jpg').read_bytes() == large.getvalue()
+        # nothing is written on the event loop's thread
+        assert threading.get_ident() not in small.threads | large.threads